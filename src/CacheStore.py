@@ -0,0 +1,660 @@
+import os
+import os.path
+import time
+import tempfile
+import cPickle
+import mmap
+import gc
+import hashlib
+import collections
+import serialization
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+#==============================================================================
+# exceptions
+#==============================================================================
+class CacheStoreError(Exception): pass
+
+
+#==============================================================================
+# helpers
+#==============================================================================
+def WriteAtomically(filename, objects, data=()):
+    '''Pickles the given objects, in order, followed by the strings in data,
+    to a temporary file in the same directory and then renames it to
+    filename, so readers never see a partially written file.
+    '''
+    fd, temp = tempfile.mkstemp('.tmp', '', os.path.dirname(filename))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            for obj in objects:
+                cPickle.dump(obj, f, 1)
+            for chunk in data:
+                f.write(chunk)
+        finally:
+            f.close()
+        try:
+            os.rename(temp, filename)
+        except OSError:
+            # windows doesn't replace an existing file
+            os.remove(filename)
+            os.rename(temp, filename)
+    except:
+        try:
+            os.remove(temp)
+        except OSError: pass
+        raise
+
+
+def WithoutGC(function, *args):
+    '''Calls function with the cyclic garbage collector disabled; building
+    or walking a big graph of declarations otherwise triggers it over and
+    over for nothing.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+#==============================================================================
+# FileLock
+#==============================================================================
+class FileLock:
+    '''An advisory, exclusive lock on a file, shared by every process that
+    uses the same filename. It can be acquired again by its holder; it is
+    released when Release was called as many times as Acquire. Without
+    fcntl or msvcrt it does nothing.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.depth = 0
+        # how many times it was taken (not counting the reentrant Acquires)
+        self.count = 0
+
+
+    def Acquire(self):
+        self.depth += 1
+        if self.depth > 1:
+            return
+        self.count += 1
+        self.file = file(self.filename, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+
+
+    def Release(self):
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+
+#==============================================================================
+# CacheStore
+#==============================================================================
+class CacheStore:
+    '''Keeps parsed declarations in a cache directory, one file per entry,
+    plus a small index with the information about each entry (its
+    dependencies, header and interface). An entry can be validated from the
+    index alone, and loading it doesn't deserialize any other entry.
+    The entries can also be packed into a single file (see Pack), which is
+    mapped in memory and only read at the requested entry's offset.
+    The declarations are pickled, or stored in the flat format of the
+    serialization module if format is 'flat'; entries in either format can
+    be loaded.
+    The index records the size and the last access time of each entry, so
+    that Finish can evict the least recently used ones, and a stats file
+    keeps the counts of the last runs (see Report).
+    Many processes can share the directory: every file is replaced
+    atomically, so readers take no lock, and the writers hold a lock on the
+    directory while they change the index.
+    '''
+
+    index_name = 'index.sharppyc'
+    pack_name = 'entries.sharppyp'
+    stats_name = 'stats.sharppyc'
+    lock_name = 'lock.sharppyc'
+    # number of runs kept in the stats file
+    recent_runs = 10
+
+    def __init__(self, directory, version, format='pickle'):
+        self.directory = directory
+        self.version = version
+        self.format = format
+        self.index = None
+        # (mtime, inode) of the index file when it was read; a rewrite by
+        # another process usually changes it, but not always (coarse mtimes,
+        # a freed inode reused), so it is only trusted without the lock
+        self.index_stamp = None
+        # the lock's count when the index was read
+        self.index_count = None
+        self.lock = FileLock(os.path.join(directory, self.lock_name))
+        # (mtime, {key: (offset, length)}, mmap, offset of the entries) of
+        # the pack file
+        self.pack = None
+        # key => time it was last loaded, written to the index by Finish
+        self.accessed = {}
+        # counts of this run; misses are counted by the user of the store,
+        # which decides whether an entry is still valid
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+
+    def EntryFileName(self, key):
+        return os.path.join(self.directory, key + '.sharppyc')
+
+
+    def IndexFileName(self):
+        return os.path.join(self.directory, self.index_name)
+
+
+    def PackFileName(self):
+        return os.path.join(self.directory, self.pack_name)
+
+
+    def StatsFileName(self):
+        return os.path.join(self.directory, self.stats_name)
+
+
+    def IndexStamp(self):
+        try:
+            stat = os.stat(self.IndexFileName())
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_ino
+
+
+    def ReadIndex(self):
+        '''Returns the index, {key: info dict}. Without self.lock, it is only
+        read again from the disk if its stamp changed; holding the lock, it
+        is read again the first time in each hold, so that nothing another
+        process wrote is lost. Changes to it must be made holding the lock,
+        and saved with WriteIndex.
+        '''
+        stamp = self.IndexStamp()
+        fresh = self.lock.depth > 0 and self.index_count != self.lock.count
+        if self.index is None or fresh or stamp != self.index_stamp:
+            self.index = {}
+            if stamp is not None:
+                try:
+                    f = file(self.IndexFileName(), 'rb')
+                except IOError:
+                    # removed since the stat
+                    stamp = None
+                else:
+                    try:
+                        if cPickle.load(f) == self.version:
+                            self.index = cPickle.load(f)
+                    finally:
+                        f.close()
+            self.index_stamp = stamp
+            self.index_count = self.lock.count
+        return self.index
+
+
+    def WriteIndex(self, index):
+        WriteAtomically(self.IndexFileName(), [self.version, index])
+        self.index = index
+        self.index_stamp = self.IndexStamp()
+        self.index_count = self.lock.count
+
+
+    def Lookup(self, key):
+        'Returns the info stored with the entry, or None if there is none.'
+        return self.ReadIndex().get(key)
+
+
+    def FindKey(self, name, value):
+        'Returns the key of an entry whose info has the given value, or None.'
+        for key, info in self.ReadIndex().iteritems():
+            if info.get(name) == value:
+                return key
+        return None
+
+
+    def Load(self, key):
+        '''Returns the declarations stored in the entry, or None if the entry
+        doesn't exist or was created by another version.
+        '''
+        declarations = self.ReadEntry(key)
+        if declarations is not None:
+            self.hits += 1
+            self.accessed[key] = time.time()
+        return declarations
+
+
+    def ReadEntry(self, key):
+        'Returns the declarations of the loose entry, or of the packed one.'
+        try:
+            f = file(self.EntryFileName(key), 'rb')
+        except IOError:
+            return self.LoadPacked(key)
+        try:
+            if cPickle.load(f) != self.version:
+                return None
+            return self.Decode(f.read())
+        finally:
+            f.close()
+
+
+    def Encode(self, declarations):
+        '''Returns the declarations as a string in the store's format. Graphs
+        too deep for cPickle are stored in the flat format anyway.
+        '''
+        if self.format != 'flat':
+            try:
+                return WithoutGC(cPickle.dumps, declarations, 1)
+            except RuntimeError:
+                # maximum recursion depth exceeded
+                pass
+        return cPickle.dumps(WithoutGC(serialization.Dumps, declarations), 1)
+
+
+    def Decode(self, data):
+        'Returns the declarations encoded in data, in either format.'
+        obj = WithoutGC(cPickle.loads, data)
+        if isinstance(obj, serialization.FlatData):
+            return WithoutGC(serialization.Loads, obj)
+        return obj
+
+
+    def ReadPack(self):
+        '''Returns ({key: (offset, length)}, mmap, base) of the pack file, or
+        None if there is none; the entries' offsets are relative to base.
+        The file is only opened again if it was rewritten.
+        '''
+        filename = self.PackFileName()
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            self.ClosePack()
+            return None
+        if self.pack is None or self.pack[0] != mtime:
+            self.ClosePack()
+            f = file(filename, 'rb')
+            try:
+                if cPickle.load(f) != self.version:
+                    return None
+                offsets = cPickle.load(f)
+                base = f.tell()
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self.pack = mtime, offsets, data, base
+        return self.pack[1:]
+
+
+    def ClosePack(self):
+        if self.pack is not None:
+            self.pack[2].close()
+            self.pack = None
+
+
+    def LoadPacked(self, key):
+        'Returns the declarations of the entry from the pack file, or None.'
+        pack = self.ReadPack()
+        if pack is None or key not in pack[0]:
+            return None
+        offsets, data, base = pack
+        offset, length = offsets[key]
+        return self.Decode(data[base+offset:base+offset+length])
+
+
+    def Pack(self):
+        '''Moves every entry (loose or already packed) into the pack file,
+        which starts with the version and the {key: (offset, length)} of the
+        encoded declarations that follow it (see Encode). Returns the number
+        of entries.
+        '''
+        self.lock.Acquire()
+        try:
+            return self.PackLocked()
+        finally:
+            self.lock.Release()
+
+
+    def PackLocked(self, packed_only=False):
+        '''Pack, holding self.lock. With packed_only, the pack file is only
+        rewritten with its own entries that are still in the index, and the
+        loose entries are left alone.
+        '''
+        chunks, loose = self.Chunks(packed_only)
+        # the offsets are relative to the end of the header, so they don't
+        # depend on the header's own size
+        keys = chunks.keys()
+        keys.sort()
+        offsets = {}
+        position = 0
+        for key in keys:
+            offsets[key] = position, len(chunks[key])
+            position += len(chunks[key])
+        self.ClosePack()
+        WriteAtomically(self.PackFileName(), [self.version, offsets],
+                        [chunks[key] for key in keys])
+        for filename in loose:
+            try:
+                os.remove(filename)
+            except OSError: pass
+        return len(keys)
+
+
+    def Chunks(self, packed_only=False):
+        '''Returns ({key: encoded declarations}, [filename]) of the entries
+        in the index, loose or packed (only packed with packed_only), and the
+        files of the loose ones. Must be called holding self.lock.
+        '''
+        chunks = {}
+        index = self.ReadIndex()
+        pack = self.ReadPack()
+        if pack is not None:
+            offsets, data, base = pack
+            for key, (offset, length) in offsets.iteritems():
+                # leave out the evicted entries
+                if key in index:
+                    chunks[key] = data[base+offset:base+offset+length]
+        loose = []
+        if packed_only:
+            return chunks, loose
+        for key in index.keys():
+            filename = self.EntryFileName(key)
+            try:
+                f = file(filename, 'rb')
+            except IOError:
+                continue
+            try:
+                if cPickle.load(f) == self.version:
+                    chunks[key] = f.read()
+            finally:
+                f.close()
+            loose.append(filename)
+        return chunks, loose
+
+
+    def Export(self, filename):
+        '''Writes every entry to a bundle that Import can add to another
+        cache: the version, {key: (offset, length, md5 digest, info)} and
+        the encoded declarations. Returns the number of entries.
+        '''
+        if not os.path.isdir(self.directory):
+            raise CacheStoreError, 'No cache in %s' % self.directory
+        self.lock.Acquire()
+        try:
+            chunks, loose = self.Chunks()
+            index = self.ReadIndex()
+        finally:
+            self.lock.Release()
+        keys = chunks.keys()
+        keys.sort()
+        table = {}
+        position = 0
+        for key in keys:
+            chunk = chunks[key]
+            digest = hashlib.md5(chunk).hexdigest()
+            table[key] = position, len(chunk), digest, index[key]
+            position += len(chunk)
+        WriteAtomically(filename, [self.version, table],
+                        [chunks[key] for key in keys])
+        return len(keys)
+
+
+    def Import(self, filename):
+        '''Adds the entries of a bundle written by Export that this cache
+        doesn't have, skipping the ones that don't match their digest.
+        Returns the number of entries added.
+        '''
+        try:
+            f = file(filename, 'rb')
+        except IOError, e:
+            raise CacheStoreError, 'Can\'t read %s: %s' % (filename, e)
+        try:
+            if cPickle.load(f) != self.version:
+                raise CacheStoreError, \
+                      '%s was exported by another version' % filename
+            table = cPickle.load(f)
+            data = f.read()
+        finally:
+            f.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        count = 0
+        self.lock.Acquire()
+        try:
+            index = self.ReadIndex()
+            for key, (offset, length, digest, info) in table.iteritems():
+                chunk = data[offset:offset+length]
+                if key in index or hashlib.md5(chunk).hexdigest() != digest:
+                    continue
+                WriteAtomically(self.EntryFileName(key), [self.version],
+                                [chunk])
+                index[key] = dict(info, atime=time.time())
+                count += 1
+            self.WriteIndex(index)
+        finally:
+            self.lock.Release()
+        return count
+
+
+    def Store(self, key, declarations, info):
+        '''Writes the declarations to the entry's file and adds info to the
+        index. Returns the entry's filename.
+        '''
+        filename = self.EntryFileName(key)
+        data = self.Encode(declarations)
+        # the entry is written under the lock too, so that a Pack running
+        # in another process doesn't remove it before it is in the index
+        self.lock.Acquire()
+        try:
+            WriteAtomically(filename, [self.version], [data])
+            index = self.ReadIndex()
+            index[key] = dict(info, size=len(data), atime=time.time())
+            self.WriteIndex(index)
+        finally:
+            self.lock.Release()
+        self.stored += 1
+        return filename
+
+
+    def TotalSize(self):
+        'Returns the size in bytes of the entries in the index.'
+        total = 0
+        for info in self.ReadIndex().itervalues():
+            total += info.get('size', 0)
+        return total
+
+
+    def Finish(self, max_bytes=None):
+        '''Records when the entries loaded by this run were accessed, evicts
+        the least recently accessed entries until the entries take at most
+        max_bytes (None means no limit) and adds the counts of this run to
+        the stats file. Returns the number of evicted entries.
+        '''
+        self.lock.Acquire()
+        try:
+            return self.FinishLocked(max_bytes)
+        finally:
+            self.lock.Release()
+
+
+    def FinishLocked(self, max_bytes):
+        index = self.ReadIndex()
+        for key, atime in self.accessed.iteritems():
+            if key in index:
+                index[key]['atime'] = atime
+        self.accessed = {}
+        evicted = []
+        if max_bytes is not None:
+            order = [(info.get('atime', 0), key)
+                     for key, info in index.iteritems()]
+            order.sort()
+            total = self.TotalSize()
+            for atime, key in order:
+                if total <= max_bytes:
+                    break
+                total -= index.pop(key).get('size', 0)
+                evicted.append(key)
+        self.WriteIndex(index)
+        packed = False
+        for key in evicted:
+            try:
+                os.remove(self.EntryFileName(key))
+            except OSError:
+                packed = True
+        if packed:
+            # drop them from the pack, without packing the loose entries
+            self.PackLocked(True)
+        runs = self.ReadRuns()
+        runs.append({'time': time.time(), 'hits': self.hits,
+                     'misses': self.misses, 'stored': self.stored,
+                     'evicted': len(evicted)})
+        WriteAtomically(self.StatsFileName(),
+                        [self.version, runs[-self.recent_runs:]])
+        self.hits = self.misses = self.stored = 0
+        return len(evicted)
+
+
+    def ReadRuns(self):
+        '''Returns the counts of the last runs, oldest first, as dicts with
+        time, hits, misses, stored and evicted.
+        '''
+        try:
+            f = file(self.StatsFileName(), 'rb')
+        except IOError:
+            return []
+        try:
+            if cPickle.load(f) != self.version:
+                return []
+            return cPickle.load(f)
+        finally:
+            f.close()
+
+
+    def Report(self, count=3):
+        '''Returns a description of the cache: its size, the counts of the
+        last runs and the count largest entries of each interface.
+        '''
+        index = self.ReadIndex()
+        lines = ['Cache %s: %d entries, %d KB' % \
+                 (self.directory, len(index), self.TotalSize() / 1024)]
+        runs = self.ReadRuns()
+        if runs:
+            lines.append('Recent runs:')
+        for run in runs:
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(run['time']))
+            lines.append('   %s  %4d hits %4d misses %4d stored %4d evicted'
+                         % (when, run['hits'], run['misses'], run['stored'],
+                            run['evicted']))
+        interfaces = {}
+        for key, info in index.iteritems():
+            entries = interfaces.setdefault(info.get('interface'), [])
+            entries.append((info.get('size', 0), info.get('header')))
+        if interfaces:
+            lines.append('Largest entries:')
+        names = interfaces.keys()
+        names.sort()
+        for interface in names:
+            entries = interfaces[interface]
+            entries.sort()
+            entries.reverse()
+            lines.append('   %s' % interface)
+            for size, header in entries[:count]:
+                lines.append('      %8d KB  %s' % (size / 1024, header))
+        return '\n'.join(lines)
+
+
+#==============================================================================
+# MemoryCache
+#==============================================================================
+class MemoryCache:
+    '''A least recently used cache of parsed declarations kept in memory.
+    Entries are evicted when there are more than max_entries or when their
+    sizes add up to more than max_bytes; None means no limit. The newest
+    entry is never evicted, even if it alone is over the budget.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # key => (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def Get(self, key):
+        'Returns the value stored for key, or None.'
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # move it to the most recently used end
+        self.entries[key] = value, size
+        self.hits += 1
+        return value
+
+
+    def Put(self, key, value, size=0):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = value, size
+        self.size += size
+        while len(self.entries) > 1 and self.OverBudget():
+            old_key, (old_value, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+
+    def OverBudget(self):
+        if self.max_entries is not None and \
+           len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+
+    def Stats(self):
+        return 'Memory cache: %d hits, %d misses, %d evictions, ' \
+               '%d entries (%d KB)' % (self.hits, self.misses,
+                                       self.evictions, len(self.entries),
+                                       self.size / 1024)
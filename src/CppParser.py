@@ -2,6 +2,8 @@
 # See http://www.boost.org/ for more information.
 
 import GCCXMLParser
+import CacheStore
+import ProcessRunner
 import tempfile
 import shutil
 import os
@@ -11,12 +13,56 @@ import settings
 import shutil
 import shelve
 import cPickle
+import multiprocessing
+import hashlib
+import re
+import threading
+from declarations import Class, rename_map
 
 #==============================================================================
 # exceptions
 #==============================================================================
 class CppParserError(Exception): pass
 
+
+#==============================================================================
+# helpers
+#==============================================================================
+def NamesKey(names):
+    'Returns the requested names in a hashable, order independent form.'
+    if names is None:
+        return None
+    names = list(names)
+    names.sort()
+    return tuple(names)
+
+
+include_re = re.compile(r'^[ \t]*#[ \t]*include[ \t]*[<"]([^>"]+)[>"]', re.M)
+# any include directive, including the ones include_re can't resolve, like
+# computed includes and #include_next
+directive_re = re.compile(r'^[ \t]*#[ \t]*include', re.M)
+
+# prefixes of the filenames stored in the cache relative to an include dir
+# (see CppParser.Relocate), for filenames that were relative or absolute
+RELATIVE_PREFIX = '<include>/'
+ABSOLUTE_PREFIX = '<abs-include>/'
+
+
+def _ParseInWorker(args):
+    '''Runs in a worker process of CppParser.ParseInParallel: parses one
+    header with gccxml and returns the declarations pickled.
+    '''
+    includes, defines, options, renames, header, tail, names = args
+    for name, value in options.items():
+        setattr(settings, name, value)
+    # the declarations are renamed as they are built
+    rename_map.clear()
+    rename_map.update(renames)
+    parser = CppParser(includes, defines)
+    declarations = parser.ParseWithGCCXML(header, tail, names)
+    return (header, tail, names), cPickle.dumps(declarations, 1), parser.runs
+
+
 #==============================================================================
 # CppParser
 #==============================================================================
@@ -40,91 +86,227 @@ class CppParser:
         self.delete_cache = False
         self.cache_dir = cache_dir
         self.cache_files = []
-        self.mem_cache = {}
+        self.mem_cache = CacheStore.MemoryCache(settings.MEM_CACHE_ENTRIES,
+                                                settings.MEM_CACHE_BYTES)
+        # cache key => (pickled declarations parsed by Prefetch, {interface
+        # that requested them and didn't take them yet: None})
+        self.prefetched = {}
+        # cache key => declarations split from a ParseUnity run
+        self.unity_parsed = {}
+        # real path of a file => real paths of the files it includes
+        self.includes_of = {}
+        # real path of a file => the include dirs its includes were found
+        # in, or None if some include couldn't be resolved (see Includes)
+        self.include_dirs_of = {}
+        # real path of a header => include dirs it needs (NeededIncludeDirs)
+        self.needed_dirs = {}
+        # header name => filename found by FindHeader
+        self.found = {}
+        # relative path => first include dir that has it (IncludeDirFor)
+        self.header_index = {}
+        # name => include dirs that have it directly (see TopIndex)
+        self.top_index = None
+        # directory => dict with the names in it
+        self.listings = {}
+        # [(header, ProcessRunner.RunResult)] of every gccxml run
+        self.runs = []
+        # cache key => digest of the preprocessed header (see Preprocess)
+        self.preprocessed = {}
+        # filename => (mtime, size, md5 digest of the contents)
+        self.digests = {}
+        # (absolute path, path as given) of the include dirs and the current
+        # dir, which the filenames stored in the cache are relative to
+        self.roots = [(os.path.abspath(x), x) for x in includes + ['.']]
+        self.relocated = {}
+        self.restored = {}
+        self.store = None
         # create the cache dir
         if cache_dir:
             try:
                 os.makedirs(cache_dir)
             except OSError: pass  
+            self.store = CacheStore.CacheStore(cache_dir, version,
+                                               settings.CACHE_FORMAT)
 
 
     def __del__(self):
         self.Close()
 
         
-    def _IncludeParams(self, filename):
-        includes = self.includes[:]
+    def _IncludeDirs(self, filename, extra_dirs=()):
+        if settings.MINIMAL_INCLUDES:
+            includes = self.NeededIncludeDirs(filename)
+        else:
+            includes = self.includes[:]
         filedir = os.path.dirname(filename)
         if not filedir:
             filedir = '.'
-        includes.insert(0, filedir)
-        includes = ['-I "%s"' % x for x in includes]
+        includes[0:0] = [filedir] + list(extra_dirs)
+        return includes
+
+
+    def _IncludeParams(self, filename, extra_dirs=()):
+        includes = ['-I "%s"' % x for x in self._IncludeDirs(filename, extra_dirs)]
         return ' '.join(includes)
 
 
     def _DefineParams(self):
         defines = ['-D "%s"' % x for x in self.defines]
         return ' '.join(defines)
+
+
+    def GCCXMLArgs(self, filename, xmlfile, extra_dirs=()):
+        '''Returns the argument vector that runs gccxml on filename. If
+        xmlfile is None, gccxml only preprocesses the file, to stdout.
+        '''
+        args = ['gccxml', '--gccxml-compiler', 'g++']
+        if xmlfile is None:
+            args.append('--preprocess')
+        for include in self._IncludeDirs(filename, extra_dirs):
+            args.extend(['-I', include])
+        for define in self.defines:
+            args.extend(['-D', define])
+        args.append(filename)
+        if xmlfile is not None:
+            args.append('-fxml=' + xmlfile)
+        return args
     
     
     def FindHeader(self, header):
+        filename = self.found.get(header)
+        if filename is not None:
+            return filename
         if os.path.isfile(header):
-            return header
-        for path in self.includes:
-            filename = os.path.join(path, header)  
-            if os.path.isfile(filename):
-                return filename
+            filename = header
         else:
-            name = os.path.basename(header)
-            raise RuntimeError, 'Header file "%s" not found!' % name
+            path = self.IncludeDirFor(header)
+            if path is None:
+                name = os.path.basename(header)
+                raise RuntimeError, 'Header file "%s" not found!' % name
+            filename = os.path.join(path, header)
+        self.found[header] = filename
+        return filename
+
+
+    def IncludeDirFor(self, name):
+        '''Returns the first include dir that has the file name (a relative
+        path), or None. The include dirs are listed once each, instead of
+        looking for every file in each of them.
+        '''
+        if name in self.header_index:
+            return self.header_index[name]
+        result = None
+        if not os.path.isabs(name):
+            subdir, basename = os.path.split(name)
+            if subdir:
+                candidates = self.includes
+            else:
+                candidates = self.TopIndex().get(name.lower(), ())
+            # the listings only rule dirs out; the filesystem decides whether
+            # a name that differs in case is the same file
+            for path in candidates:
+                listing = self.Listing(os.path.join(path, subdir))
+                if basename.lower() in listing and \
+                   os.path.isfile(os.path.join(path, name)):
+                    result = path
+                    break
+        self.header_index[name] = result
+        return result
+
+
+    def TopIndex(self):
+        '''Returns {name: [include dirs that have it]}, of the names directly
+        in the include dirs, in the dirs' order; the names are lowercase
+        (see Listing).
+        '''
+        if self.top_index is None:
+            self.top_index = {}
+            for path in self.includes:
+                for name in self.Listing(path):
+                    self.top_index.setdefault(name, []).append(path)
+        return self.top_index
+
+
+    def Listing(self, dir):
+        '''Returns a dict with the names in the given directory, read once.
+        The names are lowercase, so that a header included with another case
+        is still found where the filesystem ignores case.
+        '''
+        listing = self.listings.get(dir)
+        if listing is None:
+            try:
+                listing = dict.fromkeys([x.lower() for x in os.listdir(dir)])
+            except OSError:
+                listing = {}
+            self.listings[dir] = listing
+        return listing
+
+
+    def NeededIncludeDirs(self, filename):
+        '''Returns the include dirs, in their order, that have the files
+        filename includes directly or not (see Includes); all of them if
+        some include can't be resolved by scanning. Files found only by
+        gccxml's own search, like the system headers, are not scanned.
+        '''
+        filename = os.path.realpath(filename)
+        if filename not in self.needed_dirs:
+            needed = {}
+            for included in self.IncludedFiles(filename):
+                dirs = self.include_dirs_of[included]
+                if dirs is None:
+                    result = self.includes[:]
+                    break
+                for dir in dirs:
+                    needed[dir] = None
+            else:
+                result = [x for x in self.includes if x in needed]
+            self.needed_dirs[filename] = result
+        return self.needed_dirs[filename][:]
     
             
-    def AppendTail(self, filename, tail):
-        '''Creates a temporary file, appends the text tail to it, and returns
-        the filename of the file.
+    def WrapHeader(self, filename, tail):
+        '''Creates a temporary header that includes the given one by its
+        absolute path and is followed by the text tail, and returns its
+        filename. The declarations of the header keep its location.
         '''
         temp = tempfile.mktemp('.h') 
-        shutil.copyfile(filename, temp)
-        f = file(temp, 'a')
-        f.write('\n\n'+tail)
+        f = file(temp, 'w')
+        f.write('#include "%s"\n\n' % os.path.abspath(filename))
+        f.write(tail)
         f.close()   
         return temp
 
 
-    def ParseWithGCCXML(self, header, tail):
-        '''Parses the given header using gccxml and GCCXMLParser.
+    def ParseWithGCCXML(self, header, tail, names=None, extra_dirs=()):
+        '''Parses the given header using gccxml and GCCXMLParser. If names is
+        given, only those declarations (and their dependencies) are built.
+        extra_dirs are searched for includes right after the header's dir.
         '''
         header = self.FindHeader(header) 
         if tail:
-            filename = self.AppendTail(header, tail)
+            filename = self.WrapHeader(header, tail)
+            extra_dirs = [os.path.dirname(header) or '.'] + list(extra_dirs)
         else:
             filename = header
         xmlfile = tempfile.mktemp('.xml')
         try:            
-            # get the params
-            includes = self._IncludeParams(filename)
-            defines = self._DefineParams()
+            args = self.GCCXMLArgs(filename, xmlfile, extra_dirs)
+            # --debug needs the xml in a regular file, to keep a copy
+            if settings.PIPE_XML and not settings.DEBUG and \
+               hasattr(os, 'mkfifo'):
+                return self.ParseFromPipe(header, args, xmlfile, names)
             # call gccxml
-            cmd = 'gccxml --gccxml-compiler g++ %s %s %s -fxml=%s'
-            status = os.system(cmd % (includes, defines, filename, xmlfile))
-            if status != 0 or not os.path.isfile(xmlfile):
-                raise CppParserError, 'Error executing gccxml'
+            result = ProcessRunner.Run(args, settings.GCCXML_TIMEOUT)
+            self.runs.append((header, result))
+            if not result.Succeeded() or not os.path.isfile(xmlfile):
+                self.GCCXMLError(header, result)
             # parse the resulting xml
-            declarations = GCCXMLParser.ParseDeclarations(xmlfile)
-            # make the declarations' location to point to the original file
-            if tail:
-                for decl in declarations:
-                    decl_filename = os.path.normpath(os.path.normcase(decl.location[0]))
-                    filename = os.path.normpath(os.path.normcase(filename))
-                    if decl_filename == filename:
-                        decl.location = header, decl.location[1]
-            # return the declarations                         
-            return declarations
+            return self.ParseXML(xmlfile, names)
         finally:
             if settings.DEBUG and os.path.isfile(xmlfile):
-                filename = os.path.basename(header)
-                filename = os.path.splitext(filename)[0] + '.xml'
-                shutil.copy(xmlfile, filename)
+                debug_xml = os.path.basename(header)
+                debug_xml = os.path.splitext(debug_xml)[0] + '.xml'
+                shutil.copy(xmlfile, debug_xml)
             # delete the temporary files
             try:
                 os.remove(xmlfile)
@@ -132,88 +314,619 @@ class CppParser:
                     os.remove(filename)
             except OSError: pass                
 
-    def Parse(self, header, interface, tail=None):
+
+    def ParseXML(self, xmlfile, names):
+        'Returns the declarations in the gccxml output, as settings ask.'
+        return GCCXMLParser.ParseDeclarations(xmlfile, settings.STREAM_XML,
+                                              names, settings.PROFILE_PARSER,
+                                              settings.LAZY_PARSE,
+                                              settings.KEEP_NAMESPACES,
+                                              settings.DROP_NAMESPACES)
+
+
+    def ParseFromPipe(self, header, args, fifo, names):
+        '''Runs gccxml (args) with its output going to the named pipe fifo,
+        and parses the xml while gccxml is still writing it. Returns the
+        declarations.
+        '''
+        import fcntl
+        os.mkfifo(fifo)
+        # open both ends before gccxml starts, so nothing waits on the open:
+        # the read end with O_NONBLOCK (cleared afterwards), and then a write
+        # end of our own, kept until gccxml ends, so that the parser only
+        # sees the end of the file then, even if gccxml never opened it
+        reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        writer = os.open(fifo, os.O_WRONLY)
+        flags = fcntl.fcntl(reader, fcntl.F_GETFL)
+        fcntl.fcntl(reader, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        stream = os.fdopen(reader, 'rb')
+        process = ProcessRunner.Start(args)
+        results = []
+        def Wait():
+            try:
+                results.append(process.Wait(settings.GCCXML_TIMEOUT))
+            finally:
+                os.close(writer)
+        waiter = threading.Thread(target=Wait)
+        waiter.start()
+        error = None
+        try:
+            try:
+                declarations = self.ParseXML(stream, names)
+            except:
+                error = sys.exc_info()
+                # don't leave gccxml blocked on a pipe nobody reads
+                process.Kill()
+            waiter.join()
+        finally:
+            stream.close()
+        result = results[0]
+        self.runs.append((header, result))
+        if not result.Succeeded():
+            self.GCCXMLError(header, result)
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return declarations
+
+
+    def Preprocess(self, header, tail, names):
+        '''Runs only the preprocessor over what ParseWithGCCXML would parse,
+        and returns a digest of the output, with the line markers dropped and
+        the whitespace normalized, so that it doesn't change when only
+        comments or whitespace do, and of the rest of the CacheKey parts;
+        None if the preprocessor failed.
+        '''
+        header = self.FindHeader(header)
+        extra_dirs = []
+        if tail:
+            filename = self.WrapHeader(header, tail)
+            extra_dirs = [os.path.dirname(header) or '.']
+        else:
+            filename = header
+        output = tempfile.TemporaryFile()
+        try:
+            args = self.GCCXMLArgs(filename, None, extra_dirs)
+            result = ProcessRunner.Run(args, settings.GCCXML_TIMEOUT, output)
+            if not result.Succeeded():
+                return None
+            output.seek(0)
+            # the header's path too: the locations must still point at it
+            md5 = hashlib.md5()
+            for part in self._KeyParams(header, tail, names):
+                md5.update(repr(part))
+                md5.update('\0')
+            for line in output:
+                tokens = line.split()
+                if tokens and not line.startswith('#'):
+                    md5.update(' '.join(tokens) + ' ')
+            return md5.hexdigest()
+        finally:
+            output.close()
+            if tail:
+                try:
+                    os.remove(filename)
+                except OSError: pass
+
+
+    def GCCXMLError(self, header, result):
+        raise CppParserError, 'Error executing gccxml on %s (%s):\n%s' % \
+              (header, result.Describe(), result.output)
+
+
+    def Parse(self, header, interface, tail=None, names=None):
         '''Parses the given filename related to the given interface and returns
-        the (declarations, headerfile). The header returned is normally the
-        same as the given to this method (except that it is the full path),
-        except if tail is not None: in this case, the header is copied to a temp
-        filename and the tail code is appended to it before being passed on to
-        gccxml.  This temp filename is then returned.
+        the (declarations, headerfile). The header returned is the same as
+        the given to this method. If tail is not None, gccxml parses a
+        temporary header that includes the header and is followed by the tail
+        code (see WrapHeader).
+        If names is given, only the declarations with those full names and the
+        ones they depend on are returned.
         '''        
         if tail is None:
             tail = ''
         tail.strip()
-        declarations = self.GetCache(header, interface, tail)
+        declarations = self.GetCache(header, interface, tail, names)
+        data = None
+        if self.prefetched:
+            # taken even if they are cached by now, or they'd be kept
+            data = self.TakePrefetched(self.CacheKey(header, tail, names),
+                                       interface)
         if declarations is None:
-            declarations = self.ParseWithGCCXML(header, tail)
-            self.CreateCache(header, interface, tail, declarations)
+            key = self.CacheKey(header, tail, names)
+            if data is not None:
+                declarations = cPickle.loads(data)
+            elif key in self.unity_parsed:
+                declarations = self.unity_parsed.pop(key)
+            else:
+                declarations = self.ParseWithGCCXML(header, tail, names)
+            self.CreateCache(header, interface, tail, declarations, names)
         return declarations, header
 
-    def CacheFileName(self, interface):
-        interface_name = os.path.basename(interface)
-        cache_file = os.path.splitext(interface_name)[0] + '.sharppyc'
-        cache_file = os.path.join(self.cache_dir, cache_file) 
-        return cache_file
-        
 
-    def GetCache(self, header, interface, tail):
-        key = (header, interface, tail)
+    def ParseInParallel(self, parses, jobs):
+        '''Runs gccxml and GCCXMLParser for each (header, tail, names) in
+        parses, in a pool of jobs worker processes. Returns a dict of
+        {(header, tail, names): pickled declarations}.
+        '''
+        # the workers get this process' settings and renames, which they
+        # don't inherit where they are spawned instead of forked
+        options = {}
+        for name, value in vars(settings).items():
+            if name.isupper():
+                options[name] = value
+        args = [(self.includes, self.defines, options, rename_map, header,
+                 tail, NamesKey(names)) for header, tail, names in parses]
+        results = {}
+        if not args:
+            return results
+        # the workers share this process' limit of concurrent gccxml runs
+        pool = multiprocessing.Pool(min(jobs, len(args)),
+                                    ProcessRunner.SetSlots,
+                                    (ProcessRunner.Slots(),))
+        try:
+            for key, data, runs in pool.imap_unordered(_ParseInWorker, args):
+                results[key] = data
+                self.runs.extend(runs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+        return results
+
+
+    def Prefetch(self, requests, jobs):
+        '''Parses the (header, interface, tail, names) requests that are not
+        cached yet in parallel (see ParseInParallel); each header and tail is
+        parsed only once. Parse picks up the results afterwards; they are
+        kept until every interface that requested them did (see
+        TakePrefetched), so that they don't depend on the memory cache.
+        '''
+        parses = {}
+        for header, interface, tail, names in requests:
+            if self.GetCache(header, interface, tail, names) is None:
+                parses[(header, tail, NamesKey(names))] = None
+        results = self.ParseInParallel(parses.keys(), jobs)
+        for header, interface, tail, names in requests:
+            data = results.get((header, tail, NamesKey(names)))
+            if data is not None:
+                key = self.CacheKey(header, tail, names)
+                waiting = self.prefetched.setdefault(key, (data, {}))[1]
+                waiting[interface] = None
+
+
+    def TakePrefetched(self, key, interface):
+        '''Returns the pickled declarations that Prefetch parsed for key, or
+        None. They are dropped once every interface that requested them
+        took them.
+        '''
+        if key not in self.prefetched:
+            return None
+        data, waiting = self.prefetched[key]
+        if interface in waiting:
+            del waiting[interface]
+        if not waiting:
+            del self.prefetched[key]
+        return data
+
+    def ParseUnity(self, requests):
+        '''Parses the (header, interface, tail, names) requests that are not
+        cached yet with a single gccxml run, over a temporary header that
+        includes all the headers followed by all the distinct tails, so the
+        headers they have in common are only parsed once. The declarations
+        are split back per request (see SplitUnity); Parse picks them up.
+        '''
+        pending = {}
+        for header, interface, tail, names in requests:
+            key = self.CacheKey(header, tail, names)
+            if key not in pending and key not in self.unity_parsed and \
+               self.GetCache(header, interface, tail, names) is None:
+                pending[key] = header, tail, names
+        if len(pending) < 2:
+            return
+        keys = pending.keys()
+        keys.sort()
+        # write the unity header, remembering the lines of each tail
+        lines = []
+        dirs = []
+        all_names = {}
+        tail_lines = {} # tail => (first line, last line)
+        for key in keys:
+            header, tail, names = pending[key]
+            filename = os.path.abspath(self.FindHeader(header))
+            include = '#include "%s"' % filename
+            if include not in lines:
+                lines.append(include)
+            if os.path.dirname(filename) not in dirs:
+                dirs.append(os.path.dirname(filename))
+            if names is None:
+                all_names = None
+            elif all_names is not None:
+                for name in names:
+                    all_names[name] = None
+        for key in keys:
+            header, tail, names = pending[key]
+            if tail and tail not in tail_lines:
+                lines.append('')
+                first = len(lines) + 1
+                lines.extend(tail.split('\n'))
+                tail_lines[tail] = first, len(lines)
+        unity = tempfile.mktemp('.h')
+        f = file(unity, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        try:
+            if all_names is not None:
+                all_names = all_names.keys()
+            declarations = self.ParseWithGCCXML(unity, '', all_names, dirs)
+        finally:
+            try:
+                os.remove(unity)
+            except OSError: pass
+        for key in keys:
+            header, tail, names = pending[key]
+            self.unity_parsed[key] = self.SplitUnity(declarations, unity,
+                header, tail_lines.get(tail), [x for x, _, _ in pending.values()])
+
+
+    def SplitUnity(self, declarations, unity, header, tail_lines, headers):
+        '''Returns the declarations of a ParseUnity run that a parse of the
+        header alone would have produced: the ones from the header, from the
+        tail lines of the unity file, and from the files the header includes.
+        The other headers in headers (and what only they include) are left
+        out. Overloads found in different headers are not unique here, even
+        if the headers don't include each other.
+        '''
+        realpath = {}
+        def Real(filename):
+            if filename not in realpath:
+                realpath[filename] = os.path.realpath(filename)
+            return realpath[filename]
+        header = self.FindHeader(header)
+        others = dict([(Real(self.FindHeader(x)), None) for x in headers])
+        visible = self.IncludedFiles(Real(header))
+        unity = Real(unity)
+        def Belongs(filename):
+            filename = Real(filename)
+            return filename in visible or \
+                   (filename not in others and filename != unity)
+        result = declarations.__class__()
+        for decl in declarations:
+            filename, line = decl.location
+            if Real(filename) == unity:
+                if tail_lines is None or \
+                   not tail_lines[0] <= line <= tail_lines[1]:
+                    continue
+            elif filename and not Belongs(filename):
+                continue
+            result.append(decl)
+        result.files = [x for x in getattr(declarations, 'files', [])
+                        if Belongs(x)]
+        return result
+
+
+    def IncludedFiles(self, filename):
+        '''Returns a dict with the real paths of filename and every file it
+        includes, directly or not, by scanning the #include directives
+        (regardless of any #if around them).
+        '''
+        found = {filename: None}
+        pending = [filename]
+        while pending:
+            for included in self.Includes(pending.pop()):
+                if included not in found:
+                    found[included] = None
+                    pending.append(included)
+        return found
+
+
+    def Includes(self, filename):
+        '''Returns the real paths of the files directly included by the
+        given one that could be found; remembered in self.includes_of. The
+        include dirs where they were found go to self.include_dirs_of.
+        '''
+        if filename in self.includes_of:
+            return self.includes_of[filename]
+        result = []
+        dirs = []
+        try:
+            f = file(filename)
+            try:
+                text = f.read()
+            finally:
+                f.close()
+        except IOError:
+            text = ''
+        names = include_re.findall(text)
+        for name in names:
+            dir = self.IncludeDirFor(name)
+            # needed even if the file is found next to the including one,
+            # which gcc doesn't look at for <> includes
+            if dir is not None and dir not in dirs:
+                dirs.append(dir)
+            included = os.path.join(os.path.dirname(filename), name)
+            if not os.path.isfile(included):
+                if dir is None:
+                    continue
+                included = os.path.join(dir, name)
+            result.append(os.path.realpath(included))
+        if len(names) != len(directive_re.findall(text)):
+            dirs = None
+        self.includes_of[filename] = result
+        self.include_dirs_of[filename] = dirs
+        return result
+
+
+    def FileDigest(self, filename):
+        '''Returns the md5 hex digest of the contents of the given file, or
+        None if it can't be read. The digest is only recomputed when the
+        file's mtime or size changes.
+        '''
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        stamp = self.digests.get(filename)
+        if stamp is not None and stamp[:2] == (st.st_mtime, st.st_size):
+            return stamp[2]
+        try:
+            f = file(filename, 'rb')
+            try:
+                digest = hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        self.digests[filename] = st.st_mtime, st.st_size, digest
+        return digest
+
+
+    def _KeyParams(self, filename, tail, names):
+        '''Returns the parts of CacheKey other than the contents of the header
+        (found as filename); Preprocess digests them too.
+        '''
+        # the paths are relative to the include dirs, so that the keys are
+        # the same in another checkout
+        includes = [self.Relocate(os.path.abspath(x))
+                    for x in self._IncludeDirs(filename)]
+        parts = [self.Relocate(os.path.abspath(filename)), includes,
+                 self._DefineParams(), tail,
+                 # a demand-driven parse only holds the requested declarations
+                 NamesKey(names)]
+        if names is not None:
+            parts.extend([settings.KEEP_NAMESPACES, settings.DROP_NAMESPACES])
+        return parts
+
+
+    def CacheKey(self, header, tail, names):
+        '''Returns a digest of everything that determines the result of
+        parsing the header: its path and contents, the include and define
+        parameters, the tail and the requested names. The files the header
+        includes are checked separately, see Dependencies.
+        '''
+        filename = self.FindHeader(header)
+        parts = [self.FileDigest(filename)] + \
+                self._KeyParams(filename, tail, names)
+        md5 = hashlib.md5()
+        for part in parts:
+            md5.update(repr(part))
+            md5.update('\0')
+        return md5.hexdigest()
+
+
+    def Dependencies(self, declarations):
+        '''Returns the [(filename, mtime, size, digest)] of the files that
+        gccxml read to produce the given declarations (the File elements).
+        Files that don't exist on disk, like gccxml's builtins, are skipped.
+        The filenames are relocated (see Relocate).
+        '''
+        dependencies = []
+        for filename in getattr(declarations, 'files', []):
+            digest = self.FileDigest(filename)
+            if digest is not None:
+                mtime, size, digest = self.digests[filename]
+                dependencies.append((self.Relocate(filename), mtime, size,
+                                     digest))
+        return dependencies
+
+
+    def DependenciesChanged(self, dependencies):
+        '''Returns True if any of the files returned by Dependencies has
+        different contents now. Files whose mtime and size are unchanged
+        are not read.
+        '''
+        for filename, mtime, size, digest in dependencies:
+            filename = self.Restore(filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return True
+            if (st.st_mtime, st.st_size) == (mtime, size):
+                continue
+            if self.FileDigest(filename) != digest:
+                return True
+        return False
+
+
+    def Relocate(self, filename):
+        '''Returns filename relative to the include dir (or the current dir)
+        that holds it, with RELATIVE_PREFIX or ABSOLUTE_PREFIX, so that the
+        cache can be used by a checkout in another place. Other filenames
+        are returned as they are.
+        '''
+        result = self.relocated.get(filename)
+        if result is not None:
+            return result
+        result = filename
+        path = os.path.abspath(filename)
+        best = ''
+        for root, given in self.roots:
+            if len(root) > len(best) and \
+               (path == root or path.startswith(root + os.sep)):
+                best = root
+        if best:
+            relative = path[len(best)+1:] or '.'
+            if os.path.isabs(filename):
+                prefix = ABSOLUTE_PREFIX
+            else:
+                prefix = RELATIVE_PREFIX
+            result = prefix + relative.replace(os.sep, '/')
+        self.relocated[filename] = result
+        return result
+
+
+    def Restore(self, filename):
+        '''Returns the filename given to Relocate in this checkout: the first
+        include dir (or the current dir) that has it.
+        '''
+        result = self.restored.get(filename)
+        if result is not None:
+            return result
+        result = filename
+        for prefix in (RELATIVE_PREFIX, ABSOLUTE_PREFIX):
+            if filename.startswith(prefix):
+                relative = os.path.join(*filename[len(prefix):].split('/'))
+                candidates = [os.path.normpath(os.path.join(given, relative))
+                              for root, given in self.roots]
+                result = candidates[0]
+                for candidate in candidates:
+                    if os.path.exists(candidate):
+                        result = candidate
+                        break
+                if prefix == ABSOLUTE_PREFIX:
+                    result = os.path.abspath(result)
+                break
+        self.restored[filename] = result
+        return result
+
+
+    def MapLocations(self, declarations, function):
+        '''Replaces the filename of the location of each declaration (and
+        class member) and the filenames in declarations.files with
+        function(filename). Returns what it replaced, for UnmapLocations.
+        '''
+        saved = []
+        seen = {}
+        pending = list(declarations)
+        while pending:
+            decl = pending.pop()
+            if id(decl) in seen:
+                continue
+            seen[id(decl)] = None
+            filename, line = decl.location
+            if filename:
+                saved.append((decl, decl.location))
+                decl.location = function(filename), line
+            if isinstance(decl, Class):
+                pending.extend(decl)
+        files = getattr(declarations, 'files', [])
+        declarations.files = [function(x) for x in files]
+        return files, saved
+
+
+    def UnmapLocations(self, declarations, saved):
+        files, locations = saved
+        declarations.files = files
+        for decl, location in locations:
+            decl.location = location
+
+
+    def LoadCache(self, key):
+        '''Returns the declarations of the entry in the store, with their
+        locations restored (see Relocate), or None.
+        '''
+        declarations = self.store.Load(key)
+        if declarations is not None:
+            self.MapLocations(declarations, self.Restore)
+        return declarations
+
+
+    def EntrySize(self, declarations, size=None):
+        '''Returns the size charged to the memory cache for the declarations:
+        their size in the disk cache if given, or their pickled size, which
+        is only computed if the cache has a byte budget.
+        '''
+        if self.mem_cache.max_bytes is None:
+            return 0
+        if size is not None:
+            return size
+        return len(cPickle.dumps(declarations, 1))
+
+
+    def GetCache(self, header, interface, tail, names=None):
+        key = self.CacheKey(header, tail, names)
         # try memory cache first
-        if key in self.mem_cache:
-            return self.mem_cache[key]
+        declarations = self.mem_cache.Get(key)
+        if declarations is not None:
+            return declarations
         
         # get the cache from the disk
-        if self.cache_dir is None:
+        if self.store is None:
             return None 
-        header = self.FindHeader(header) 
-        cache_file = self.CacheFileName(interface)    
-        if os.path.isfile(cache_file):
-            f = file(cache_file, 'rb')
-            try:
-                version = cPickle.load(f)
-                if version != self.version:
-                    return None
-                cache = cPickle.load(f)
-                if cache.has_key(key):
-                    self.cache_files.append(cache_file)
-                    return cache[key]
-                else:
-                    return None
-            finally:
-                f.close()
+        info = self.store.Lookup(key)
+        if info is None or self.DependenciesChanged(info['dependencies']):
+            declarations = self.GetPreprocessedCache(key, header, interface,
+                                                     tail, names)
+            if declarations is None:
+                self.store.misses += 1
+            return declarations
+        declarations = self.LoadCache(key)
+        if declarations is None:
+            self.store.misses += 1
         else:
+            self.cache_files.append(self.store.EntryFileName(key))
+            self.mem_cache.Put(key, declarations,
+                               self.EntrySize(declarations, info.get('size')))
+        return declarations
+
+
+    def GetPreprocessedCache(self, key, header, interface, tail, names):
+        '''With settings.PREFLIGHT, looks for an entry whose header preprocessed
+        to the same thing (see Preprocess), that is, one that only differs in
+        comments or whitespace. If there is one, it is stored again under
+        key and returned. Lines in the locations may be off in that case.
+        '''
+        if not settings.PREFLIGHT:
             return None
+        # a header missed before (say by Prefetch) isn't preprocessed again
+        if key not in self.preprocessed:
+            self.preprocessed[key] = self.Preprocess(header, tail, names)
+        preprocessed = self.preprocessed[key]
+        if preprocessed is None:
+            return None
+        old_key = self.store.FindKey('preprocessed', preprocessed)
+        if old_key is None:
+            return None
+        declarations = self.LoadCache(old_key)
+        if declarations is not None:
+            self.CreateCache(header, interface, tail, declarations, names)
+        return declarations
 
 
-    def CreateCache(self, header, interface, tail, declarations):
-        key = (header, interface, tail)
+    def CreateCache(self, header, interface, tail, declarations, names=None):
+        key = self.CacheKey(header, tail, names)
         
-        # our memory cache only holds one item
-        self.mem_cache.clear() 
-        self.mem_cache[key] = declarations
-
         # save the cache in the disk
-        if self.cache_dir is None:
-            return
-        header = self.FindHeader(header) 
-        cache_file = self.CacheFileName(interface)
-        if os.path.isfile(cache_file):
-            f = file(cache_file, 'rb')
+        cache_file = None
+        size = None
+        if self.store is not None:
+            info = {'header': header, 'interface': interface,
+                    'dependencies': self.Dependencies(declarations)}
+            if settings.PREFLIGHT:
+                if key not in self.preprocessed:
+                    self.preprocessed[key] = self.Preprocess(header, tail,
+                                                             names)
+                info['preprocessed'] = self.preprocessed.pop(key)
+            # the locations are stored relocated, and put back afterwards
+            saved = self.MapLocations(declarations, self.Relocate)
             try:
-                version = cPickle.load(f)
-                cache = cPickle.load(f)
+                cache_file = self.store.Store(key, declarations, info)
             finally:
-                f.close()
-        else:
-            cache = {}
-        cache[key] = declarations
-        self.cache_files.append(cache_file)
-        f = file(cache_file, 'wb')
-        try:
-            cPickle.dump(self.version, f, 1)
-            cPickle.dump(cache, f, 1)
-        finally:
-            f.close()
+                self.UnmapLocations(declarations, saved)
+            self.cache_files.append(cache_file)
+            size = self.store.Lookup(key)['size']
+        self.mem_cache.Put(key, declarations,
+                           self.EntrySize(declarations, size))
         return cache_file 
 
 
@@ -2,6 +2,8 @@
 # See http://www.boost.org/ for more information.
 
 import os
+import re
+import declarations
 
 #==============================================================================
 # Exporter
@@ -17,7 +19,9 @@ class Exporter(object):
       self.interface_file = None
       self.declarations = []
       if info.extra_headers != None:
-         self.includes = info.extra_headers
+         # a copy: several infos can share the list, and each exporter adds
+         # its own headers to its includes
+         self.includes = list(info.extra_headers)
       else:
          self.includes = []
       self.module = info.module
@@ -35,6 +39,24 @@ class Exporter(object):
    def Tail(self):
       return self.parser_tail
 
+   tail_typedef_re = re.compile(r'typedef\s+.+?\s+(\w+)\s*;')
+
+   def RequestedNames(self):
+      '''
+      Returns the full names of the declarations this exporter will look up:
+      the exported name, the names given to add_method and the typedefs
+      declared in the tail.
+      '''
+      names = []
+      if self.info.name:
+         names.append(self.info.name)
+      added_methods = self.info.__added__
+      if added_methods:
+         names.extend([name for name, rename in added_methods])
+      if self.parser_tail:
+         names.extend(self.tail_typedef_re.findall(self.parser_tail))
+      return names
+
    def Parse(self, parser):
       self.parser = parser
       header = self.info.include
@@ -80,11 +102,28 @@ class Exporter(object):
       'Subclasses must override this to do the real work.'
       pass
 
+   def OutputFiles(self):
+      '''
+      Returns the names of the files Write writes to, from the
+      *_output_file attributes set by Export.
+      '''
+      files = []
+      for dir, attribute in [(self.cxx_dir, 'cxx_adapter_output_file'),
+                             (self.cxx_dir, 'c_wrapper_output_file'),
+                             (self.csharp_dir, 'csharp_output_file')]:
+         name = getattr(self, attribute, None)
+         if name:
+            files.append(os.path.join(dir, name))
+      return files
+
    def GetDeclarations(self, fullname):
-      decls = []
-      for decl in self.declarations:
-         if decl.getFullCPlusPlusName() == fullname:
-            decls.append(decl)
+      if isinstance(self.declarations, declarations.DeclarationList):
+         decls = self.declarations.Lookup(fullname)[:]
+      else:
+         decls = []
+         for decl in self.declarations:
+            if decl.getFullCPlusPlusName() == fullname:
+               decls.append(decl)
       if not decls:
          raise RuntimeError, 'no %s declaration found!' % fullname
       return decls
@@ -97,5 +97,8 @@ class FreeTypesExporter(Exporter.Exporter):
       except IOError, (errno, strerror):
          print "I/O error (%s) [%s]: %s" % (errno, csharp_out, strerror)
 
+   def RequestedNames(self):
+      return self.info.funcs + self.info.enums + self.info.constants
+
    def Name(self):
       return self.info.holder_class
@@ -5,7 +5,9 @@ import declarations
 import elementtree.ElementTree
 import xml.parsers.expat
 import copy
+import gc
 import re
+import time
 import utils
 
 
@@ -19,6 +21,37 @@ class ParserError(Exception): pass
 class InvalidContextError(ParserError): pass
 
 
+#==============================================================================
+# ElementRecord
+#==============================================================================
+class ElementRecord(object):
+    '''Compact stand-in for an ElementTree element, used when the xml is read
+    in streaming mode. Only the attributes listed for its tag in
+    GCCXMLParser.used_attributes are kept, in a tuple, together with the
+    records of the children the parser looks at (Argument and EnumValue).
+    '''
+
+    __slots__ = ('tag', 'values', 'children', 'index')
+
+    def __init__(self, tag, values, children=()):
+        self.tag = tag
+        self.values = values
+        self.children = children
+        # attribute name => position in values, shared by the tag's records
+        self.index = _attribute_index.get(tag, {})
+
+    def get(self, name, default=None):
+        if name not in self.index:
+            return default
+        value = self.values[self.index[name]]
+        if value is None:
+            return default
+        return value
+
+    def __iter__(self):
+        return iter(self.children)
+
+
 #==============================================================================
 # GCCXMLParser
 #==============================================================================
@@ -26,44 +59,283 @@ class GCCXMLParser(object):
     'Parse a GCC_XML file and extract the top-level declarations.'
     
     interested_tags = {'Class':0, 'Function':0, 'Variable':0, 'Enumeration':0}
-    
+
+    # attributes read by the Parse* methods for each tag; in streaming mode
+    # everything else is dropped while the xml is being read
+    _function_attributes = ('name', 'returns', 'context', 'location',
+                            'incomplete', 'throw')
+    _method_attributes = ('name', 'returns', 'context', 'access', 'static',
+                          'virtual', 'pure_virtual', 'const', 'location',
+                          'throw')
+    _class_attributes = ('name', 'abstract', 'location', 'context',
+                         'incomplete', 'access', 'bases', 'members')
+    _field_attributes = ('name', 'access', 'context', 'type', 'extern',
+                         'location', 'init')
+    used_attributes = {
+        'Namespace' : ('name', 'context'),
+        'File' : ('name',),
+        'Variable' : _field_attributes,
+        'Field' : _field_attributes,
+        'Function' : _function_attributes,
+        'OperatorFunction' : _function_attributes,
+        'Class' : _class_attributes,
+        'Struct' : _class_attributes,
+        'FundamentalType' : ('name',),
+        'ArrayType' : ('type', 'min', 'max'),
+        'ReferenceType' : ('type',),
+        'PointerType' : ('type',),
+        'FunctionType' : ('returns',),
+        'MethodType' : ('basetype', 'returns'),
+        'Method' : _method_attributes,
+        'OperatorMethod' : _method_attributes,
+        'Converter' : _method_attributes,
+        'Constructor' : ('name', 'access', 'context', 'location'),
+        'Destructor' : ('name', 'access', 'context', 'virtual', 'location'),
+        'Typedef' : ('name', 'type', 'context'),
+        'Enumeration' : ('name', 'location', 'context', 'incomplete', 'access'),
+        # children
+        'Argument' : ('type', 'default'),
+        'EnumValue' : ('name', 'init'),
+    }
+    child_tags = {'Argument':0, 'EnumValue':0}
+    # tags whose Argument children are read by GetArguments
+    argument_tags = {'Function':0, 'OperatorFunction':0, 'FunctionType':0,
+                     'MethodType':0, 'Method':0, 'OperatorMethod':0,
+                     'Converter':0, 'Constructor':0}
+
+    # tags of the declarations that exporters look up by their full name
+    named_tags = {'Class':0, 'Struct':0, 'Function':0, 'Variable':0,
+                  'Enumeration':0, 'Typedef':0}
+
+    # tag => unbound Parse* method; built once, after the class (see
+    # _BuildDispatchTable)
+    dispatch_table = {}
+
+    def __init__(self, stream=False, names=None, profile=False, lazy=True,
+                 keep=(), drop=()):
+        '''If stream is True, the xml is read incrementally and only compact
+        ElementRecords are kept, instead of the whole ElementTree.
+        If names is given, only the declarations with those full names and
+        the ones they reference are returned (see Prune); if lazy is True,
+        only those are built, too (see RequestedIds). The declarations in the
+        keep namespaces are added to the ones requested by name, and those in
+        the drop namespaces are left out.
+        If profile is True, the count, time and declarations produced for
+        each tag are recorded and printed at the end of Parse.
+        '''
+        self.stream = stream
+        self.names = names
+        self.profile = profile
+        self.lazy = lazy
+        self.keep = keep
+        self.drop = drop
+
     def Parse(self, filename):
-        self.elements = self.GetElementsFromXML(filename)
+        if self.stream:
+            self.elements = self.GetElementsFromStream(filename)
+        else:
+            self.elements = self.GetElementsFromXML(filename)
         # high level declarations
-        self.declarations = []
-        self._names = {}
+        self.declarations = declarations.DeclarationList()
+        self._scope_names = {}
+        self._types = {}
+        # tag => [count, total time, own time, declarations]
+        self.tag_stats = {}
+        self._profile_stack = []
+        # the worklist of the innermost Resolve call, or None
+        self._worklist = None
         # parse the elements
-        for id in self.elements:
-            element, decl = self.elements[id]
-            if decl is None: 
-                try:
-                    self.ParseElement(id, element)
-                except InvalidContextError:
-                    pass # ignore those nodes with invalid context 
-                         # (workaround gccxml bug)
+        if self.names is None or not self.lazy:
+            ids = self.elements.keys()
+        else:
+            ids = self.RequestedIds()
+        # the parse only allocates, so don't let the cyclic collector rescan
+        # the growing declaration graph over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            # ignore those nodes with invalid context (workaround gccxml bug)
+            self.Resolve(ids, skip_invalid=True)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if self.names is not None:
+            self.declarations = self.Prune(self.declarations)
+        self.declarations.files = self.GetFiles()
+        if self.profile:
+            self.PrintProfile(filename)
          
 
     def Declarations(self):
         return self.declarations
 
 
+    def GetFiles(self):
+        '''Returns the sorted names of all the files gccxml read, as listed
+        by the File elements (not only the files with parsed declarations).
+        '''
+        files = [element.get('name') for element, decl in
+                 self.elements.itervalues() if element.tag == 'File']
+        files.sort()
+        return files
+
+
+    def RequestedIds(self):
+        '''Returns the ids of the elements whose full name is in self.names.
+        The free operators are always included, because the exporters look
+        for them by their parameters instead of by name.
+        '''
+        wanted = self.WantedNames()
+        ids = []
+        for id, (element, decl) in self.elements.iteritems():
+            if element.tag == 'OperatorFunction':
+                ids.append(id)
+            elif element.tag in self.named_tags:
+                name = self.GetFullName(element)
+                if (name in wanted or InNamespaces(name, self.keep)) and \
+                   not InNamespaces(name, self.drop):
+                    ids.append(id)
+        return ids
+
+
+    def WantedNames(self):
+        'Returns self.names normalized (see NormalizeName), as a dict.'
+        wanted = {}
+        for name in self.names:
+            wanted[self.NormalizeName(name)] = None
+        return wanted
+
+
+    def Prune(self, decls):
+        '''Returns a DeclarationList with only the declarations reachable from
+        the requested ones (the same RequestedIds picks), following the
+        references between declarations: members, bases, types, results,
+        parameters, typedef targets and so on, plus everything declared
+        inside a reachable class. The declarations in the drop namespaces are
+        left out.
+        '''
+        wanted = self.WantedNames()
+        pending = []
+        scoped = {} # full name of a scope => declarations inside it
+        for decl in decls:
+            name = decl.getFullCPlusPlusName()
+            scoped.setdefault(ScopeName(name), []).append(decl)
+            if isinstance(decl, declarations.Operator) or \
+               ((name in wanted or InNamespaces(name, self.keep)) and \
+                not InNamespaces(name, self.drop)):
+                pending.append(decl)
+        reached = {}
+        while pending:
+            obj = pending.pop()
+            if isinstance(obj, declarations.Declaration):
+                if id(obj) in reached:
+                    continue
+                reached[id(obj)] = None
+                pending.extend(vars(obj).itervalues())
+                if isinstance(obj, declarations.Class):
+                    pending.extend(scoped.get(obj.getFullCPlusPlusName(), ()))
+            elif isinstance(obj, (list, tuple)):
+                pending.extend(obj)
+            elif isinstance(obj, dict):
+                pending.extend(obj.itervalues())
+        result = declarations.DeclarationList()
+        for decl in decls:
+            if id(decl) in reached and \
+               not InNamespaces(decl.getFullCPlusPlusName(), self.drop):
+                result.append(decl)
+        return result
+
+
+    def GetFullName(self, element):
+        '''Returns the full C++ name of the given element, computed from the
+        xml alone, without building any declaration.
+        '''
+        name = self.NormalizeName(element.get('name', ''))
+        scope = self.GetScopeName(element.get('context'))
+        if scope:
+            return scope + '::' + name
+        return name
+
+
+    def GetScopeName(self, id):
+        'Returns the full name of the namespace or class with the given id.'
+        if id in self._scope_names:
+            return self._scope_names[id]
+        if id not in self.elements or \
+           self.elements[id][0].get('name') == '::':
+            scope = ''
+        else:
+            scope = self.GetFullName(self.elements[id][0])
+        self._scope_names[id] = scope
+        return scope
+
+
+    def NormalizeName(self, name):
+        '''Strips the whitespace from template names the same way
+        declarations.Declaration does, so names can be compared.
+        '''
+        if name.find('<') == -1:
+            return name
+        name = declarations.Declaration.ws_match.sub('', name)
+        name = declarations.Declaration.template_munge.sub('> >', name)
+        return declarations.Declaration.template_munge.sub('> >', name)
+
+
     def AddDecl(self, decl):
-        if decl.getFullCPlusPlusName() in self._names:
-            decl.is_unique= False
-            for d in self.declarations:
-                if d.getFullCPlusPlusName() == decl.getFullCPlusPlusName():
-                    d.is_unique = False
-        self._names[decl.getFullCPlusPlusName()] = 0
+        if self.profile and self._profile_stack:
+            self.tag_stats[self._profile_stack[-1][0]][3] += 1
+        others = self.declarations.Lookup(decl.getFullCPlusPlusName())
+        if others:
+            # the first overload was unique until now; the rest are already
+            # marked
+            others[0].is_unique = False
+            decl.is_unique = False
         self.declarations.append(decl)
 
         
     def ParseElement(self, id, element):
-        method = 'Parse' + element.tag
-        if hasattr(self, method):
-            func = getattr(self, method)
-            func(id, element)
+        func = self.dispatch_table.get(element.tag, GCCXMLParser.ParseUnknown)
+        if self.profile:
+            self.ProfileElement(func, id, element)
         else:
-            self.ParseUnknown(id, element)
+            func(self, id, element)
+
+
+    def ProfileElement(self, func, id, element):
+        '''Calls func to parse the element, recording the time it took in
+        self.tag_stats. The own time of a tag excludes the time spent parsing
+        the elements it depends on.
+        '''
+        stats = self.tag_stats.setdefault(element.tag, [0, 0.0, 0.0, 0])
+        # [tag, time spent in nested ParseElement calls]
+        frame = [element.tag, 0.0]
+        self._profile_stack.append(frame)
+        start = time.clock()
+        try:
+            func(self, id, element)
+        finally:
+            elapsed = time.clock() - start
+            self._profile_stack.pop()
+            if self._profile_stack:
+                self._profile_stack[-1][1] += elapsed
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed - frame[1]
+
+
+    def PrintProfile(self, filename):
+        'Prints self.tag_stats, the tags with the most own time first.'
+        order = [(stats[2], tag) for tag, stats in self.tag_stats.items()]
+        order.sort()
+        order.reverse()
+        print
+        print 'Parser profile for %s:' % filename
+        print '   %-20s %8s %10s %10s %8s' % ('tag', 'count', 'total (s)',
+                                              'own (s)', 'decls')
+        for _, tag in order:
+            count, total, own, decls = self.tag_stats[tag]
+            print '   %-20s %8d %10.3f %10.3f %8d' % (tag, count, total, own,
+                                                    decls)
 
             
     def GetElementsFromXML(self,filename):
@@ -89,6 +361,47 @@ class GCCXMLParser(object):
         return elements
 
 
+    def GetElementsFromStream(self, filename):
+        '''Extracts a dictionary of ElementRecords from the gcc_xml file,
+        reading it incrementally and discarding each element as soon as its
+        record is built.
+        '''
+        elements = {}
+        root = None
+        depth = 0
+        try:
+            events = elementtree.ElementTree.iterparse(filename, ('start', 'end'))
+            for event, element in events:
+                if event == 'start':
+                    if root is None:
+                        root = element
+                        if root.tag != 'GCC_XML':
+                            raise InvalidXMLError, 'Not a valid GCC_XML file'
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    id = element.get('id')
+                    if id:
+                        elements[id] = self.MakeRecord(element), None
+                    # drop the element (and its children) right away
+                    root.clear()
+        except xml.parsers.expat.ExpatError:
+            raise InvalidXMLError, 'Not an XML file: %s' % filename
+        if root is None:
+            raise InvalidXMLError, 'Not a valid GCC_XML file'
+        return elements
+
+
+    def MakeRecord(self, element):
+        'Returns a ElementRecord with the attributes of element we care about.'
+        names = self.used_attributes.get(element.tag, ())
+        values = tuple([element.get(x) for x in names])
+        children = [self.MakeRecord(x) for x in element
+                    if x.tag in self.child_tags]
+        return ElementRecord(element.tag, values, tuple(children))
+
+
     def GetDecl(self, id):
         if id not in self.elements:
             if id == '_0':
@@ -99,14 +412,124 @@ class GCCXMLParser(object):
 
         elem, decl = self.elements[id]
         if decl is None:
-            self.ParseElement(id, elem)
+            self.Resolve([id])
             elem, decl = self.elements[id]
             if decl is None:
                 raise ParserError, 'Could not parse element: %s' % elem.tag
         return decl
 
 
+    def Resolve(self, ids, skip_invalid=False):
+        '''Parses the elements with the given ids, after parsing every element
+        they reference, using an explicit worklist instead of recursing
+        through ParseElement and GetDecl. Each entry of the worklist is
+        (id, step): "expand" pushes the unparsed references of the element,
+        "parse" builds its declaration and "members" attaches the members of a
+        class, which ParseClass defers so that classes never wait for their
+        own members.
+        If skip_invalid is True, the elements that raise InvalidContextError
+        are left unparsed instead of aborting the whole worklist.
+        '''
+        outer_worklist = self._worklist
+        worklist = self._worklist = []
+        self.PushReferences(worklist, ids)
+        elements = self.elements
+        expanded = {}
+        try:
+            while worklist:
+                id, step = worklist.pop()
+                element, decl = elements[id]
+                try:
+                    if step == 'members':
+                        self.AddMembers(decl, element)
+                    elif decl is not None:
+                        continue
+                    elif step == 'parse':
+                        self.ParseElement(id, element)
+                    elif id not in expanded:
+                        # an id that was expanded but not parsed yet would be
+                        # part of a cycle; GetDecl resolves it on its own
+                        expanded[id] = None
+                        refs = [x for x in self.GetReferences(element)
+                                if x in elements and elements[x][1] is None]
+                        if refs:
+                            worklist.append((id, 'parse'))
+                            self.PushReferences(worklist, refs)
+                        else:
+                            self.ParseElement(id, element)
+                except InvalidContextError:
+                    # the elements depending on this one will fail as well
+                    # when they ask for it through GetDecl
+                    if not skip_invalid:
+                        self.AddPendingMembers(worklist)
+                        raise
+        finally:
+            self._worklist = outer_worklist
+
+
+    def AddPendingMembers(self, worklist):
+        '''Attaches the members of the classes in the worklist that is being
+        abandoned, so that they are not left without their members.
+        '''
+        for id, step in worklist:
+            if step == 'members':
+                element, decl = self.elements[id]
+                try:
+                    self.AddMembers(decl, element)
+                except InvalidContextError:
+                    pass
+
+
+    def PushReferences(self, worklist, refs):
+        '''Pushes the given ids in the worklist, so that they are expanded in
+        the order given.
+        '''
+        refs = list(refs)
+        refs.reverse()
+        for ref in refs:
+            worklist.append((ref, 'expand'))
+
+
+    def GetReferences(self, element):
+        '''Returns the ids of the elements the given element refers to through
+        its type, returns, basetype, context, location, bases and throw
+        attributes and its arguments. Class members are not included (see
+        Resolve).
+        '''
+        refs = []
+        # ElementTree elements keep their attributes in a dict, which is
+        # faster to query directly
+        get = getattr(element, 'attrib', element).get
+        for name, kind in _reference_attributes.get(element.tag, ()):
+            value = get(name)
+            if not value:
+                continue
+            if kind == 'type':
+                # strip the cv qualifiers
+                refs.append(value.rstrip('cvr'))
+            elif kind == 'scope':
+                refs.append(value.split(':')[0])
+            elif kind == 'bases':
+                refs.extend([x.split(':')[-1] for x in value.split()])
+            else:
+                refs.extend([x.rstrip('cvr') for x in value.split()])
+        if element.tag in self.argument_tags:
+            for child in element:
+                if child.tag == 'Argument':
+                    refs.append(child.get('type').rstrip('cvr'))
+        return refs
+
+
     def GetType(self, id):
+        '''Returns the Type for the given type id, which may carry cv
+        qualifiers (e.g. "_123cv"). Types are interned by the raw id, so the
+        same instance is returned for every reference to it: the result is
+        shared and must not be modified (see GetArguments).
+        '''
+        if id in self._types:
+            return self._types[id]
+        raw_id = id
+
         def Check(id, feature):
             pos = id.find(feature)
             if pos != -1:
@@ -120,17 +543,23 @@ class GCCXMLParser(object):
         restricted, id = Check(id, 'r')
         decl = self.GetDecl(id)
         if isinstance(decl, declarations.Type):
-            res = copy.deepcopy(decl)
-            if const:
-                res.const = const
-            if volatile: 
-                res.volatile = volatile
-            if restricted:
-                res.restricted = restricted
+            if const or volatile or restricted:
+                # a shallow copy is enough: the qualifiers are the only
+                # difference, and Type.__init__ does not need to run again
+                res = copy.copy(decl)
+                if const:
+                    res.const = const
+                if volatile: 
+                    res.volatile = volatile
+                if restricted:
+                    res.restricted = restricted
+            else:
+                res = decl
         else:
             res = declarations.Type(decl, decl.getFullCPlusPlusName(), const)
             res.volatile = volatile
             res.restricted = restricted
+        self._types[raw_id] = res
         return res            
 
     def GetLocation(self, location):
@@ -189,7 +618,12 @@ class GCCXMLParser(object):
         for child in element:
             if child.tag == 'Argument':
                 type_= self.GetType(child.get('type'))
-                type_.default = child.get('default')                
+                default = child.get('default')
+                if default is not None:
+                    # the interned type is shared; give this parameter its
+                    # own lightweight copy to hold the default value
+                    type_ = copy.copy(type_)
+                    type_.default = default
                 args.append(type_)
         return args
 
@@ -266,6 +700,15 @@ class GCCXMLParser(object):
         return hierarchy
 
         
+    def AddMembers(self, class_, element):
+        'Adds the members listed in the element to the class declaration.'
+        members = self.GetMembers(element.get('members'))
+        for member in members:
+            if type(member) is str:
+                print member
+            class_.AddMember(member)
+
+
     def GetMembers(self, member_list):
         # members must be a string with the ids of the members
         if member_list is None:
@@ -305,11 +748,14 @@ class GCCXMLParser(object):
         class_.hierarchy = self.GetHierarchy(element.get('bases'))        
         if class_.hierarchy:
             class_.bases = class_.hierarchy[0]
-        members = self.GetMembers(element.get('members'))
-        for member in members:
-            if type(member) is str:
-                print member
-            class_.AddMember(member)
+        if self._worklist is None:
+            self.AddMembers(class_, element)
+        else:
+            # let Resolve parse the members first and attach them afterwards
+            self._worklist.append((id, 'members'))
+            members = [x for x in element.get('members', '').split()
+                       if x in self.elements and self.elements[x][1] is None]
+            self.PushReferences(self._worklist, members)
 
 
     def ParseStruct(self, id, element):
@@ -483,11 +929,81 @@ class GCCXMLParser(object):
         self.Update(id, enum)
 
 
-
-def ParseDeclarations(filename):
-    'Returns a list of the top declarations found in the gcc_xml file.'
+def _BuildAttributeIndex():
+    'Returns a dict of tag => {attribute name => index in ElementRecord.values}'
+    index = {}
+    for tag, names in GCCXMLParser.used_attributes.items():
+        index[tag] = dict([(x, i) for i, x in utils.enumerate(names)])
+    return index
+
+_attribute_index = _BuildAttributeIndex()
+
+
+def _BuildReferenceTable():
+    '''Returns a dict of tag => list of (attribute, kind) for the attributes
+    that refer to other elements, in the order the Parse* methods read them,
+    for GCCXMLParser.GetReferences. Tags parsed by ParseUnknown refer to
+    nothing.
+    '''
+    kinds = [('returns', 'type'), ('basetype', 'type'), ('type', 'type'),
+             ('context', 'scope'), ('location', 'scope'), ('bases', 'bases'),
+             ('throw', 'throw')]
+    table = {}
+    for tag, names in GCCXMLParser.used_attributes.items():
+        table[tag] = [(name, kind) for name, kind in kinds if name in names]
+    return table
+
+_reference_attributes = _BuildReferenceTable()
+
+
+def _BuildDispatchTable():
+    'Returns a dict of tag => the GCCXMLParser method that parses it'
+    table = {}
+    for name in dir(GCCXMLParser):
+        tag = name[len('Parse'):]
+        if name.startswith('Parse') and tag not in ('', 'Element'):
+            table[tag] = getattr(GCCXMLParser, name)
+    return table
+
+GCCXMLParser.dispatch_table = _BuildDispatchTable()
+
+
+def ScopeName(name):
+    '''Returns the full name of the scope of the given full name, that is,
+    everything before its last "::" outside template arguments.
+    '''
+    depth = 0
+    for i in xrange(len(name) - 1, 0, -1):
+        c = name[i]
+        if c == '>':
+            depth += 1
+        elif c == '<':
+            depth -= 1
+        elif c == ':' and depth == 0 and name[i-1] == ':':
+            return name[:i-1]
+    return ''
+
+
+def InNamespaces(name, namespaces):
+    'Returns True if the full name is one of the namespaces or inside one.'
+    for namespace in namespaces:
+        namespace = namespace.lstrip(':')
+        if name == namespace or name.startswith(namespace + '::'):
+            return True
+    return False
+
+
+def ParseDeclarations(filename, stream=False, names=None, profile=False,
+                      lazy=True, keep=(), drop=()):
+    '''Returns a list of the top declarations found in the gcc_xml file. If
+    stream is True, the file is read incrementally; if names is given, only
+    the declarations with those names and their dependencies are returned,
+    and if lazy is True too, only those are built; keep and drop extend and
+    limit names by namespace; if profile is True, per tag statistics are
+    printed (see GCCXMLParser).
+    '''
         
-    parser = GCCXMLParser() 
+    parser = GCCXMLParser(stream, names, profile, lazy, keep, drop) 
     parser.Parse(filename)
     return parser.Declarations()
 
@@ -0,0 +1,219 @@
+import os
+import os.path
+import types
+import hashlib
+import cPickle
+from CacheStore import WriteAtomically
+
+
+#==============================================================================
+# exceptions
+#==============================================================================
+class FingerprintError(Exception): pass
+
+
+#==============================================================================
+# Fingerprint
+#==============================================================================
+def Fingerprint(obj):
+    '''Returns an md5 hex digest of the contents of obj: the values of its
+    strings and numbers, the items of its lists, tuples, dicts and sets,
+    the classes and attributes of its instances, the code, constants,
+    default arguments and closures of its functions and the function and
+    instance of its methods. It is the same in every run for objects with
+    the same contents. Raises FingerprintError for an object it can't look
+    into.
+    '''
+    md5 = hashlib.md5()
+    _Feed(md5, obj, {})
+    return md5.hexdigest()
+
+
+def _Feed(md5, obj, seen):
+    kind = type(obj)
+    if obj is None or kind in (bool, int, long, float, str, unicode):
+        md5.update('%s:%r;' % (kind.__name__, obj))
+        return
+    if id(obj) in seen:
+        # shared or cyclic
+        md5.update('@%d;' % seen[id(obj)])
+        return
+    seen[id(obj)] = len(seen)
+    if kind in (list, tuple):
+        md5.update(kind.__name__ + '[')
+        for item in obj:
+            _Feed(md5, item, seen)
+        md5.update(']')
+    elif kind is dict:
+        # in the order of the keys' fingerprints, which is the same in
+        # every run, unlike the order of the dict
+        items = [(Fingerprint(key), key, value) for key, value in obj.items()]
+        items.sort()
+        md5.update('dict{')
+        for fingerprint, key, value in items:
+            _Feed(md5, key, seen)
+            _Feed(md5, value, seen)
+        md5.update('}')
+    elif kind in (set, frozenset):
+        items = [(Fingerprint(item), item) for item in obj]
+        items.sort()
+        md5.update(kind.__name__ + '{')
+        for fingerprint, item in items:
+            _Feed(md5, item, seen)
+        md5.update('}')
+    elif kind is types.FunctionType:
+        md5.update('function %s.%s:' % (obj.__module__, obj.__name__))
+        _Feed(md5, obj.func_code, seen)
+        _Feed(md5, obj.func_defaults, seen)
+        cells = []
+        for cell in obj.func_closure or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                # a free variable not bound yet
+                cells.append(None)
+        _Feed(md5, cells, seen)
+    elif kind is types.CodeType:
+        # the constants hold the literals and the code of nested functions
+        md5.update('code:' + obj.co_code)
+        _Feed(md5, obj.co_names, seen)
+        _Feed(md5, obj.co_consts, seen)
+    elif kind is types.MethodType:
+        md5.update('method:')
+        _Feed(md5, obj.im_func, seen)
+        _Feed(md5, obj.im_self, seen)
+    elif kind is types.BuiltinFunctionType:
+        # the instance of a builtin method; None for a builtin function
+        md5.update('builtin %s:' % obj.__name__)
+        _Feed(md5, obj.__self__, seen)
+    elif kind in (types.ClassType, type):
+        md5.update('class %s.%s;' % (obj.__module__, obj.__name__))
+    else:
+        try:
+            attributes = vars(obj)
+        except TypeError:
+            raise FingerprintError, 'Can\'t fingerprint %r' % (obj,)
+        cls = obj.__class__
+        md5.update('%s.%s(' % (cls.__module__, cls.__name__))
+        _Feed(md5, attributes, seen)
+        md5.update(')')
+
+
+def SourcesDigest():
+    '''Returns an md5 hex digest of sharppy's own modules and templates, the
+    generator every exporter depends on.
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    names = [x for x in os.listdir(directory)
+             if os.path.splitext(x)[1] in ('.py', '.tmpl')]
+    names.sort()
+    md5 = hashlib.md5()
+    for name in names:
+        f = file(os.path.join(directory, name), 'rb')
+        try:
+            md5.update(name + '\0' + f.read() + '\0')
+        finally:
+            f.close()
+    return md5.hexdigest()
+
+
+#==============================================================================
+# output files
+#==============================================================================
+def Stamps(filenames):
+    'Returns [(filename, mtime, size)] of the given files that exist.'
+    stamps = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        stamps.append((filename, st.st_mtime, st.st_size))
+    return stamps
+
+
+def StampsChanged(stamps):
+    'Returns True if any of the files given by Stamps is missing or changed.'
+    for filename, mtime, size in stamps:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return True
+        if (st.st_mtime, st.st_size) != (mtime, size):
+            return True
+    return False
+
+
+#==============================================================================
+# Manifest
+#==============================================================================
+class Manifest:
+    '''Records, in an output directory, what each exporter that writes there
+    was generated from, so that the next run can skip the exporters whose
+    inputs didn't change (see sharppy.GenerateCode). Each entry is a dict
+    with:
+    inputs: Fingerprint of the exporter's info, header, tail, parse and of
+    the generator;
+    names: digest of the exported names when it ran;
+    dependencies: the files its declarations came from, as returned by
+    CppParser.Dependencies;
+    added: the [(name, value)] it added to the exported names;
+    outputs: the Stamps of the files it wrote.
+    Only the entries recorded in this run are saved.
+    '''
+
+    manifest_name = 'manifest.sharppy'
+
+    def __init__(self, directory, version):
+        self.filename = os.path.join(directory, self.manifest_name)
+        self.version = version
+        self.entries = self.Read()
+        self.new_entries = {}
+
+
+    def Read(self):
+        try:
+            f = file(self.filename, 'rb')
+        except IOError:
+            return {}
+        try:
+            try:
+                if cPickle.load(f) != self.version:
+                    return {}
+                return cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                return {}
+        finally:
+            f.close()
+
+
+    def Lookup(self, key):
+        'Returns the entry of the last run for key, or None.'
+        return self.entries.get(key)
+
+
+    def Record(self, key, entry):
+        self.new_entries[key] = entry
+
+
+    def Save(self):
+        WriteAtomically(self.filename, [self.version, self.new_entries])
+
+
+#==============================================================================
+# RecordingDict
+#==============================================================================
+class RecordingDict(dict):
+    '''A dict that remembers, in added, the (key, value) of each key added
+    to it with d[key] = value.
+    '''
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.added = []
+
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.added.append((key, value))
+        dict.__setitem__(self, key, value)
@@ -0,0 +1,271 @@
+import os
+import sys
+import time
+import traceback
+import tempfile
+import subprocess
+import multiprocessing
+import settings
+import utils
+
+
+#==============================================================================
+# RunResult
+#==============================================================================
+class RunResult:
+    '''The outcome of running a command: status is the exit status (None if
+    it could not be started or timed out), seconds the wall time, and
+    output what it wrote to stdout and stderr.
+    '''
+
+    def __init__(self, argv, status, seconds, output, timed_out=False):
+        self.argv = argv
+        self.status = status
+        self.seconds = seconds
+        self.output = output
+        self.timed_out = timed_out
+
+    def Succeeded(self):
+        return self.status == 0
+
+    def Outcome(self):
+        'Returns how the command ended, in a few words.'
+        if self.timed_out:
+            return 'timed out'
+        if self.status is None:
+            return 'could not be started'
+        if self.status < 0:
+            # what subprocess gives for a process killed by a signal
+            return 'killed by signal %d' % -self.status
+        return 'exit status %d' % self.status
+
+    def Describe(self):
+        if self.status is None and not self.timed_out:
+            return self.Outcome()
+        return '%s after %0.2f seconds' % (self.Outcome(), self.seconds)
+
+
+#==============================================================================
+# concurrency limit
+#==============================================================================
+# a semaphore limiting how many commands run at once, in this process and in
+# the worker processes it was given to (see SetSlots)
+_slots = None
+
+def Slots():
+    '''Returns the semaphore shared by everything that runs commands; it is
+    created with settings.JOBS slots the first time.
+    '''
+    global _slots
+    if _slots is None:
+        _slots = multiprocessing.BoundedSemaphore(max(1, settings.JOBS))
+    return _slots
+
+
+def SetSlots(slots):
+    '''Makes this process use the given semaphore (from Slots() in the parent
+    process); meant as a multiprocessing.Pool initializer.
+    '''
+    global _slots
+    _slots = slots
+
+
+#==============================================================================
+# Process
+#==============================================================================
+class Process:
+    '''A command started by Start; it holds one of the Slots until Wait
+    returns.
+    '''
+
+    def __init__(self, argv, stdout=None):
+        self.argv = argv
+        self.result = None
+        self.slots = Slots()
+        self.slots.acquire()
+        self.output = tempfile.TemporaryFile()
+        if stdout is None:
+            stdout = self.output
+        self.start = time.time()
+        try:
+            self.process = subprocess.Popen(argv, stdout=stdout,
+                                            stderr=self.output)
+        except OSError, e:
+            self.process = None
+            self.Finish(RunResult(argv, None, 0.0, str(e)))
+
+
+    def Wait(self, timeout=None):
+        '''Waits for the command to end and returns its RunResult. The
+        process is killed if it runs for more than timeout seconds since it
+        was started.
+        '''
+        if self.result is not None:
+            return self.result
+        timed_out = False
+        if timeout is None:
+            self.process.wait()
+        else:
+            while self.process.poll() is None:
+                if time.time() - self.start > timeout:
+                    self.process.kill()
+                    self.process.wait()
+                    timed_out = True
+                    break
+                time.sleep(0.01)
+        seconds = time.time() - self.start
+        self.output.seek(0)
+        text = self.output.read()
+        if timed_out:
+            return self.Finish(RunResult(self.argv, None, seconds, text, True))
+        return self.Finish(RunResult(self.argv, self.process.returncode,
+                                     seconds, text))
+
+
+    def Kill(self):
+        'Kills the command if it is still running; Wait must still be called.'
+        if self.result is None and self.process.poll() is None:
+            self.process.kill()
+
+
+    def Finish(self, result):
+        self.result = result
+        self.output.close()
+        self.slots.release()
+        return result
+
+
+#==============================================================================
+# Run
+#==============================================================================
+def Start(argv, stdout=None):
+    '''Executes argv (without a shell) once a slot is free, without waiting
+    for it to end; returns a Process. If stdout is given (a file), the
+    standard output goes there instead of to RunResult.output.
+    '''
+    return Process(argv, stdout)
+
+
+def Run(argv, timeout=None, stdout=None):
+    '''Executes argv (without a shell) once a slot is free, and returns a
+    RunResult. The process is killed if it runs for more than timeout
+    seconds. See Start for stdout.
+    '''
+    return Start(argv, stdout).Wait(timeout)
+
+
+#==============================================================================
+# ForkPool
+#==============================================================================
+class ForkError(Exception): pass
+
+
+def CanFork():
+    return hasattr(os, 'fork')
+
+
+class ForkPool:
+    '''Calls functions in forked child processes, at most jobs at a time.
+    A child starts with a copy of this process as it is when Start is
+    called, so the function sees exactly the state it would see if it were
+    called then. What a child prints is shown, and its done function
+    called, in the order the children were started. Only where os.fork is
+    available (see CanFork).
+    '''
+
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.running = [] # (pid, output file, done) in start order
+
+
+    def Start(self, function, args=(), done=None):
+        '''Calls function(*args) in a child process once there are less than
+        jobs running; done() is called after it ends.
+        '''
+        while len(self.running) >= self.jobs:
+            self.WaitOldest()
+        output = tempfile.TemporaryFile()
+        # or what is buffered would be written by the child too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                sys.stdout = sys.stderr = output
+                try:
+                    function(*args)
+                except:
+                    traceback.print_exc()
+                    status = 1
+                output.flush()
+            finally:
+                os._exit(status)
+        self.running.append((pid, output, done))
+
+
+    def WaitOldest(self):
+        '''Waits for the oldest child and calls its done function. If it
+        failed, the others are waited for without calling theirs, and
+        ForkError is raised.
+        '''
+        pid, output, done = self.running.pop(0)
+        status = self._Wait(pid, output)
+        if status != 0:
+            while self.running:
+                pid, output, done = self.running.pop(0)
+                self._Wait(pid, output)
+            if os.WIFSIGNALED(status):
+                reason = 'killed by signal %d' % os.WTERMSIG(status)
+            else:
+                reason = 'exit status %d' % os.WEXITSTATUS(status)
+            raise ForkError, 'a child process failed (%s)' % reason
+        if done is not None:
+            done()
+
+
+    def _Wait(self, pid, output):
+        'Waits for the child pid, shows its output and returns its status.'
+        status = os.waitpid(pid, 0)[1]
+        output.seek(0)
+        sys.stdout.write(output.read())
+        output.close()
+        return status
+
+
+    def Join(self):
+        'Waits for every child to end.'
+        while self.running:
+            self.WaitOldest()
+
+
+#==============================================================================
+# Report
+#==============================================================================
+def Report(runs, count=5):
+    '''Returns a summary of the given [(name, RunResult)]: the number of runs,
+    their total time, and the slowest count of them and the failed ones with
+    how they ended.
+    '''
+    if not runs:
+        return ''
+    total = 0.0
+    failed = 0
+    for name, result in runs:
+        total += result.seconds
+        if not result.Succeeded():
+            failed += 1
+    order = [(result.seconds, i) for i, (name, result) in
+             utils.enumerate(runs)]
+    order.sort()
+    order.reverse()
+    summary = 'gccxml: %d runs, %0.2f seconds' % (len(runs), total)
+    if failed:
+        summary += ', %d failed' % failed
+    lines = [summary]
+    for position, (seconds, i) in utils.enumerate(order):
+        name, result = runs[i]
+        if position < count or not result.Succeeded():
+            lines.append('   %6.2f  %s (%s)' % (seconds, name,
+                                               result.Outcome()))
+    return '\n'.join(lines)
@@ -12,7 +12,7 @@ Defines classes that represent declarations found in C++ header files.
 # version indicates the version of the declarations. Whenever a declaration
 # changes, this variable should be updated, so that the caches can be rebuilt
 # automatically
-version = '1.1'
+version = '1.3'
 
 rename_map = {}
 
@@ -1111,6 +1111,34 @@ class Typedef(Declaration):
         self.visibility = Scope.public
 
 
+#==============================================================================
+# DeclarationList
+#==============================================================================
+class DeclarationList(list):
+    '''A list of declarations that also indexes them by their full C++ name,
+    so that all the declarations (overloads) with a given name can be found
+    without scanning the list.
+    '''
+
+    def __init__(self, decls=()):
+        list.__init__(self)
+        self.names = {} # full name => list of declarations
+        self.files = [] # the files the declarations were read from
+        for decl in decls:
+            self.append(decl)
+
+    def append(self, decl):
+        list.append(self, decl)
+        self.names.setdefault(decl.getFullCPlusPlusName(), []).append(decl)
+
+    def Lookup(self, fullname):
+        '''Returns the list of declarations with the given full name, in the
+        order they were added; empty if there is none.
+        @rtype: list
+        '''
+        return self.names.get(fullname, [])
+
+
 #==============================================================================
 # Unknown
 #==============================================================================
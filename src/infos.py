@@ -15,6 +15,7 @@ import exporterutils
 import utils
 import declarations
 import policies
+import settings
 
 
 #==============================================================================
@@ -336,6 +337,14 @@ def holder(info, function):
     assert callable(function), msg
     info._Attribute('holder', function)
 
+def keep_namespace(name):
+    'Keeps all the declarations in the namespace when pruning (see --prune).'
+    settings.KEEP_NAMESPACES.append(name)
+
+def drop_namespace(name):
+    'Leaves out the declarations in the namespace when pruning (see --prune).'
+    settings.DROP_NAMESPACES.append(name)
+
 def add_method(info, name, rename=None):
     added = info._Attribute('__added__')
     if added is None:
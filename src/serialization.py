@@ -0,0 +1,275 @@
+'''
+A flat, table based serialization for declarations, used by the cache as an
+alternative to pickling the object graph. Every string and constant is
+stored once, in a table, and every object (declaration, list, tuple, dict)
+becomes a row of integer references into the tables, so the whole graph is
+a handful of lists of ints and strings that marshal can dump and load
+quickly.
+'''
+
+import marshal
+import array
+import gc
+import sys
+import time
+import types
+import cPickle
+import utils
+
+FORMAT_VERSION = 1
+
+# kinds of rows
+INSTANCE, LIST, TUPLE, DICT, LIST_INSTANCE = range(5)
+
+# the tables a reference can point into, while writing (see _Writer.Ref)
+OBJECT, STRING, CONSTANT = range(3)
+
+
+#==============================================================================
+# exceptions
+#==============================================================================
+class SerializationError(Exception): pass
+
+
+#==============================================================================
+# FlatData
+#==============================================================================
+class FlatData(str):
+    '''The result of Dumps, marked as such so that it can be told apart from
+    a pickled object graph once it is pickled itself.
+    '''
+    pass
+
+
+#==============================================================================
+# Dumps
+#==============================================================================
+class _Writer:
+    '''Builds the tables. The objects are numbered in the order they are
+    found; the row of each one starts with its kind, followed by either its
+    shape (the class and attribute names it shares with other instances) or
+    its length, and then the references to its values.
+    '''
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.constants = []
+        self.constant_ids = {}
+        self.shapes = []
+        self.shape_ids = {}
+        self.rows = [] # (header, references) of each object
+        self.object_ids = {}
+        self.pending = [] # (object index, object) of the rows to build
+
+
+    def Ref(self, value):
+        '''Returns a reference to value, index * 3 + table; they are
+        translated to indexes in the combined table at the end.
+        '''
+        kind = type(value)
+        if kind is str:
+            index = self.string_ids.get(value)
+            if index is None:
+                index = self.string_ids[value] = len(self.strings)
+                self.strings.append(value)
+            return index * 3 + STRING
+        if value is None or kind in (int, long, float, bool, unicode):
+            key = kind, value
+            index = self.constant_ids.get(key)
+            if index is None:
+                index = self.constant_ids[key] = len(self.constants)
+                self.constants.append(value)
+            return index * 3 + CONSTANT
+        index = self.object_ids.get(id(value))
+        if index is None:
+            index = self.object_ids[id(value)] = len(self.rows)
+            self.rows.append(None)
+            self.pending.append((index, value))
+        return index * 3 + OBJECT
+
+
+    def Shape(self, cls, names):
+        key = cls, names
+        index = self.shape_ids.get(key)
+        if index is None:
+            index = self.shape_ids[key] = len(self.shapes)
+            self.shapes.append(((cls.__module__, cls.__name__), names))
+        return index
+
+
+    def Row(self, value):
+        Ref = self.Ref
+        kind = type(value)
+        if kind is list:
+            return [LIST, len(value)], [Ref(x) for x in value]
+        if kind is tuple:
+            return [TUPLE, len(value)], [Ref(x) for x in value]
+        if kind is dict:
+            refs = []
+            for key, item in value.iteritems():
+                refs.append(Ref(key))
+                refs.append(Ref(item))
+            return [DICT, len(value)], refs
+        attributes = getattr(value, '__dict__', None)
+        if attributes is None:
+            raise SerializationError, 'Can\'t serialize %r' % value
+        names = tuple(attributes.keys())
+        shape = self.Shape(value.__class__, names)
+        refs = [Ref(attributes[name]) for name in names]
+        if isinstance(value, list):
+            return [LIST_INSTANCE, shape, len(value)], \
+                   [Ref(x) for x in value] + refs
+        return [INSTANCE, shape], refs
+
+
+    def Dumps(self, root):
+        root = self.Ref(root)
+        while self.pending:
+            index, value = self.pending.pop()
+            self.rows[index] = self.Row(value)
+        # the combined table is strings + constants + objects
+        offsets = {STRING: 0, CONSTANT: len(self.strings),
+                   OBJECT: len(self.strings) + len(self.constants)}
+        data = array.array('i')
+        for header, refs in self.rows:
+            data.extend(header)
+            data.extend([ref // 3 + offsets[ref % 3] for ref in refs])
+        return marshal.dumps((FORMAT_VERSION, self.strings, self.constants,
+                              self.shapes, len(self.rows), data.tostring(),
+                              root // 3 + offsets[root % 3]))
+
+
+def Dumps(obj):
+    '''Returns obj (normally a list of declarations) in the flat format, as a
+    FlatData. Raises SerializationError if it holds something other than
+    instances with a __dict__, lists, tuples, dicts, strings and constants.
+    '''
+    return FlatData(_Writer().Dumps(obj))
+
+
+#==============================================================================
+# Loads
+#==============================================================================
+def _NewInstance(cls):
+    'Returns an instance of cls, without calling its __init__.'
+    if isinstance(cls, types.ClassType):
+        return types.InstanceType(cls)
+    return cls.__new__(cls)
+
+
+def Loads(payload):
+    'Rebuilds the object serialized with Dumps.'
+    version = marshal.loads(payload)[0]
+    if version != FORMAT_VERSION:
+        raise SerializationError, 'Unknown format version %r' % version
+    version, strings, constants, shapes, count, data, root = \
+             marshal.loads(payload)
+    rows = array.array('i')
+    rows.fromstring(data)
+    for i, ((module, name), names) in utils.enumerate(shapes):
+        if module not in sys.modules:
+            __import__(module)
+        names = tuple([intern(x) for x in names])
+        shapes[i] = getattr(sys.modules[module], name), names
+    base = len(strings) + len(constants)
+    missing = object()
+    values = [intern(x) for x in strings] + constants + [missing] * count
+    get = values.__getitem__
+    # find the rows and create every object except the tuples, which can't
+    # be filled afterwards
+    positions = [0] * count
+    position = 0
+    for i in xrange(count):
+        positions[i] = position
+        kind = rows[position]
+        if kind == INSTANCE:
+            cls, names = shapes[rows[position+1]]
+            values[base+i] = _NewInstance(cls)
+            position += 2 + len(names)
+        elif kind == LIST_INSTANCE:
+            cls, names = shapes[rows[position+1]]
+            values[base+i] = _NewInstance(cls)
+            position += 3 + rows[position+2] + len(names)
+        elif kind == DICT:
+            values[base+i] = {}
+            position += 2 + 2 * rows[position+1]
+        else:
+            if kind == LIST:
+                values[base+i] = []
+            position += 2 + rows[position+1]
+    # the tuples, built after the tuples inside them
+    for i in xrange(count):
+        position = positions[i]
+        if rows[position] != TUPLE or values[base+i] is not missing:
+            continue
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            start = positions[j] + 2
+            refs = rows[start:start + rows[start-1]]
+            items = map(get, refs)
+            pending = [ref - base for ref, item in zip(refs, items)
+                       if item is missing]
+            if pending:
+                stack.extend(pending)
+            else:
+                values[base+j] = tuple(items)
+                stack.pop()
+    # fill the rest
+    for i in xrange(count):
+        position = positions[i]
+        kind = rows[position]
+        obj = values[base+i]
+        if kind == INSTANCE:
+            names = shapes[rows[position+1]][1]
+            start = position + 2
+            obj.__dict__.update(zip(names, map(get, rows[start:start+len(names)])))
+        elif kind == LIST_INSTANCE:
+            names = shapes[rows[position+1]][1]
+            start = position + 3
+            end = start + rows[position+2]
+            # bypass overridden methods, like DeclarationList.append
+            list.extend(obj, map(get, rows[start:end]))
+            obj.__dict__.update(zip(names, map(get, rows[end:end+len(names)])))
+        elif kind == LIST:
+            start = position + 2
+            obj.extend(map(get, rows[start:start+rows[position+1]]))
+        elif kind == DICT:
+            start = position + 2
+            items = map(get, rows[start:start+2*rows[position+1]])
+            obj.update(zip(items[::2], items[1::2]))
+    return values[root]
+
+
+#==============================================================================
+# Benchmark
+#==============================================================================
+def Benchmark(obj):
+    '''Prints the size and the time to save and load obj with cPickle
+    (protocol 1, as the cache uses it) and with the flat format, both with
+    the cyclic garbage collector disabled, as in the cache.
+    '''
+    def Time(function, arg):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.time()
+            result = function(arg)
+            return result, time.time() - start
+        finally:
+            gc.enable()
+    data, dump = Time(lambda x: cPickle.dumps(x, 1), obj)
+    result, load = Time(cPickle.loads, data)
+    print 'cPickle:  %8d KB  dump %6.2fs  load %6.2fs' % \
+          (len(data) / 1024, dump, load)
+    data, dump = Time(Dumps, obj)
+    result, load = Time(Loads, data)
+    print 'flat:     %8d KB  dump %6.2fs  load %6.2fs' % \
+          (len(data) / 1024, dump, load)
+
+
+if __name__ == '__main__':
+    # python serialization.py output_of_gccxml.xml
+    import GCCXMLParser
+    Benchmark(GCCXMLParser.ParseDeclarations(sys.argv[1], True))
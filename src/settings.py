@@ -7,5 +7,72 @@
 
 DEBUG = False
 
+# read the gccxml output incrementally instead of building a full ElementTree
+STREAM_XML = False
+
+# only build the declarations the exporters ask for (and their dependencies)
+LAZY_PARSE = False
+
+# only keep the declarations reachable from the ones the exporters ask for
+PRUNE_DECLARATIONS = False
+
+# namespaces whose declarations are kept or left out when LAZY_PARSE or
+# PRUNE_DECLARATIONS is set (see keep_namespace and drop_namespace)
+KEEP_NAMESPACES = []
+DROP_NAMESPACES = []
+
+# print the count and time spent per xml tag after each parse
+PROFILE_PARSER = False
+
+# print the memory cache and gccxml run statistics and the peak memory use
+# at the end of the run
+PROFILE = False
+
+# number of gccxml processes to run at the same time
+JOBS = 1
+
+# read the gccxml output from a pipe while gccxml writes it
+PIPE_XML = False
+
+# before running gccxml on a header that changed, check whether it only
+# changed in comments or whitespace by running the preprocessor
+PREFLIGHT = False
+
+# seconds after which a gccxml run is killed (None means no limit)
+GCCXML_TIMEOUT = None
+
+# parse each header once for all the interfaces, with all their tails
+SHARE_HEADERS = False
+
+# parse all the headers of a module with a single gccxml run
+UNITY_PARSE = False
+
+# move the cache entries into a single indexed file at the end of the run
+PACK_CACHE = False
+
+# format of the cache entries: 'pickle' or 'flat' (see serialization.py)
+CACHE_FORMAT = 'pickle'
+
+# size budget of the cache directory in bytes; the least recently used entries
+# are evicted at the end of a run to stay under it (None means no limit)
+CACHE_MAX_BYTES = None
+
+# give gccxml only the include dirs that the parsed header's #includes are
+# found in, instead of all of them
+MINIMAL_INCLUDES = False
+
+# skip the exporters whose inputs didn't change since the last run, as
+# recorded in a manifest in the output directories
+INCREMENTAL = False
+
+# number of processes that write the generated code (render the templates)
+# at once, where os.fork is available
+GENERATE_JOBS = 1
+
+# budget of the parser's in-memory cache of declarations: the number of
+# parse results and their total pickled size in bytes (None means no limit)
+MEM_CACHE_ENTRIES = 16
+MEM_CACHE_BYTES = None
+
 class namespaces:
     sharppy = ''
@@ -15,14 +15,57 @@ where options are:
                             the extension.
     -I <path>               Add an include path
     -D <symbol>             Define symbol
+    -j <n>                  Run up to n gccxml processes in parallel
+    --minimal-includes      Pass gccxml only the include paths that the
+                            parsed header's #includes are found in
+    --incremental           Skip the exporters whose inputs didn't change
+                            since the last run
+    --generate-jobs=<n>     Write the generated code of up to n exporters in
+                            parallel
     --out-cxx=<name>        Specify C++ output directory (default: <module>_cpp)
     --out-csharp=<name>     Specify C# output directory (default: <module>_cs)
     --sharppy-ns=<name>     Set the namespace where new types will be declared;
                             default is the empty namespace
     --debug                 Writes the xml for each file parsed in the current
                             directory
+    --stream-xml            Read the gccxml output incrementally, keeping only
+                            what the parser needs (lowers peak memory)
+    --pipe-xml              Parse the gccxml output while it is written,
+                            through a named pipe instead of a temporary file
+    --lazy-parse            Only build the declarations the exporters ask for
+                            (and the ones they depend on)
+    --prune                 Only keep (and cache) the declarations reachable
+                            from the ones the exporters ask for; see
+                            keep_namespace and drop_namespace
+    --profile-parser        Print the count and time spent per xml tag after
+                            parsing each header
+    --profile               Print the memory cache and gccxml run statistics
+                            and the peak memory use at the end
+    --share-headers         Parse a header used by several interfaces once,
+                            with the tails of all of them
+    --unity                 Parse all the headers of a module with a single
+                            gccxml run (instead of -j)
+    --gccxml-timeout=<s>    Kill gccxml if parsing a header takes longer than
+                            s seconds
+    --preflight             When a cached header changed, run only the
+                            preprocessor first; reuse the cache if the change
+                            was only in comments or whitespace
     --cache-dir=<dir>       Directory for cache files (speeds up future runs)
+    --mem-cache=<n>         Keep at most n parsed headers in memory (default 16)
+    --mem-cache-mb=<n>      Keep at most n megabytes of parsed headers in
+                            memory (default: no limit)
     --only-create-cache     Recreates all caches (doesn't generate code).
+    --pack-cache            Store all cache entries in a single indexed file
+    --cache-format=<f>      Store cache entries as 'pickle' (default) or
+                            'flat' (smaller in memory once loaded)
+    --cache-max-mb=<n>      Evict the least recently used cache entries when
+                            they take more than n megabytes
+    --cache-stats           Print the size, recent hit counts and largest
+                            entries of the cache in --cache-dir and exit
+    --export-cache=<file>   Write the entries of the cache in --cache-dir to a
+                            bundle file and exit
+    --import-cache=<file>   Add the entries of a bundle file to the cache in
+                            --cache-dir and exit
     -h, --help              Print this help and exit
     -v, --version           Print version information
 """
@@ -38,8 +81,14 @@ import gc
 import sys
 import policies
 import CppParser
+import CacheStore
+import Manifest
+import ProcessRunner
 import time
+import hashlib
 import declarations
+import utils
+import cPickle
 
 __version__ = '0.0.1'
 
@@ -75,10 +124,22 @@ def ParseArguments():
       sys.exit(1)
 
    try:
-      options, files = getopt.getopt(sys.argv[1:], 'R:I:D:vh',
+      options, files = getopt.getopt(sys.argv[1:], 'R:I:D:j:vh',
                                      ['out-cxx=', 'out-csharp=',
                                       'sharppy-ns=', 'debug', 'cache-dir=',
-                                      'only-create-cache', 'version', 'help'])
+                                      'only-create-cache', 'stream-xml',
+                                      'lazy-parse', 'profile-parser',
+                                      'profile',
+                                      'pipe-xml', 'prune',
+                                      'mem-cache=', 'mem-cache-mb=',
+                                      'share-headers', 'unity',
+                                      'gccxml-timeout=', 'preflight',
+                                      'pack-cache', 'cache-format=',
+                                      'cache-max-mb=', 'cache-stats',
+                                      'export-cache=', 'import-cache=',
+                                      'minimal-includes', 'incremental',
+                                      'generate-jobs=',
+                                      'version', 'help'])
    except getopt.GetoptError, e:
       print
       print 'ERROR:', e
@@ -90,6 +151,9 @@ def ParseArguments():
    out_csharp = None
    cache_dir = None
    create_cache = False
+   cache_stats = False
+   export_cache = None
+   import_cache = None
 
    for opt, value in options:
       if opt == '-I':
@@ -98,6 +162,12 @@ def ParseArguments():
          defines.append(value)
       elif opt == '-R':
          include_dirs.extend(RecursiveIncludes(value))
+      elif opt == '-j':
+         try:
+            settings.JOBS = max(1, int(value))
+         except ValueError:
+            print 'Error: -j expects a number of jobs!'
+            Usage()
       elif opt == '--out-cxx':
          out_cxx = value
       elif opt == '--out-csharp':
@@ -108,8 +178,73 @@ def ParseArguments():
          settings.DEBUG = True
       elif opt == '--cache-dir':
          cache_dir = value
+      elif opt == '--stream-xml':
+         settings.STREAM_XML = True
+      elif opt == '--pipe-xml':
+         settings.PIPE_XML = True
+      elif opt == '--prune':
+         settings.PRUNE_DECLARATIONS = True
+      elif opt == '--lazy-parse':
+         settings.LAZY_PARSE = True
+      elif opt == '--profile-parser':
+         settings.PROFILE_PARSER = True
+      elif opt == '--profile':
+         settings.PROFILE = True
+      elif opt == '--share-headers':
+         settings.SHARE_HEADERS = True
+      elif opt == '--unity':
+         settings.UNITY_PARSE = True
+      elif opt == '--preflight':
+         settings.PREFLIGHT = True
+      elif opt == '--gccxml-timeout':
+         try:
+            settings.GCCXML_TIMEOUT = float(value)
+         except ValueError:
+            print 'Error: --gccxml-timeout expects a number of seconds!'
+            Usage()
       elif opt == '--only-create-cache':
          create_cache = True
+      elif opt == '--pack-cache':
+         settings.PACK_CACHE = True
+      elif opt == '--cache-format':
+         if value not in ('pickle', 'flat'):
+            print 'Error: --cache-format expects pickle or flat!'
+            Usage()
+         settings.CACHE_FORMAT = value
+      elif opt == '--cache-max-mb':
+         try:
+            settings.CACHE_MAX_BYTES = max(1, int(value)) * 1024 * 1024
+         except ValueError:
+            print 'Error: --cache-max-mb expects a number of megabytes!'
+            Usage()
+      elif opt == '--cache-stats':
+         cache_stats = True
+      elif opt == '--minimal-includes':
+         settings.MINIMAL_INCLUDES = True
+      elif opt == '--incremental':
+         settings.INCREMENTAL = True
+      elif opt == '--generate-jobs':
+         try:
+            settings.GENERATE_JOBS = max(1, int(value))
+         except ValueError:
+            print 'Error: --generate-jobs expects a number of jobs!'
+            Usage()
+      elif opt == '--export-cache':
+         export_cache = value
+      elif opt == '--import-cache':
+         import_cache = value
+      elif opt == '--mem-cache':
+         try:
+            settings.MEM_CACHE_ENTRIES = max(1, int(value))
+         except ValueError:
+            print 'Error: --mem-cache expects a number of headers!'
+            Usage()
+      elif opt == '--mem-cache-mb':
+         try:
+            settings.MEM_CACHE_BYTES = max(1, int(value)) * 1024 * 1024
+         except ValueError:
+            print 'Error: --mem-cache-mb expects a number of megabytes!'
+            Usage()
       elif opt in ['-h', '--help']:
          Usage()
       elif opt in ['-v', '--version']:
@@ -119,6 +254,23 @@ def ParseArguments():
          print 'Unknown option:', opt
          Usage()
 
+   if cache_stats or export_cache or import_cache:
+      if not cache_dir:
+         print 'Error: Use --cache-dir to indicate the cache to use!'
+         Usage()
+      store = CacheStore.CacheStore(cache_dir, declarations.version)
+      try:
+         if import_cache:
+            print 'Imported %d cache entries' % store.Import(import_cache)
+         if export_cache:
+            print 'Exported %d cache entries' % store.Export(export_cache)
+      except CacheStore.CacheStoreError, e:
+         print 'Error:', e
+         sys.exit(3)
+      if cache_stats:
+         print store.Report()
+      sys.exit(0)
+
    if not files:
       Usage()
 
@@ -162,6 +314,8 @@ def CreateContext():
    context['add_method'] = infos.add_method
    context['sealed'] = infos.sealed
    context['return_array'] = infos.return_array
+   context['keep_namespace'] = infos.keep_namespace
+   context['drop_namespace'] = infos.drop_namespace
    # policies
    context['return_internal_reference'] = policies.return_internal_reference
    context['with_custodian_and_ward'] = policies.with_custodian_and_ward
@@ -188,24 +342,50 @@ def Begin():
                                 declarations.version)
    try:
       if not create_cache:
-         return GenerateCode(parser, out_cxx, out_csharp, interfaces)
+         status = GenerateCode(parser, out_cxx, out_csharp, interfaces)
+         if settings.PROFILE:
+            print parser.mem_cache.Stats()
       else:
-         return CreateCaches(parser)
+         status = CreateCaches(parser)
+      if settings.PROFILE and parser.runs:
+         print ProcessRunner.Report(parser.runs)
+      if parser.store is not None:
+         evicted = parser.store.Finish(settings.CACHE_MAX_BYTES)
+         if evicted:
+            print 'Evicted %d cache entries' % evicted
+      if settings.PACK_CACHE and parser.store is not None:
+         print 'Packed %d cache entries' % parser.store.Pack()
+      return status
    finally:
       parser.Close()
 
 def CreateCaches(parser):
-   # There is one cache file per interface so we organize the headers
-   # by interfaces.  For each interface collect the tails from the
-   # exporters sharing the same header.
+   # Organize the headers by interfaces.  For each interface collect the
+   # tails from the exporters sharing the same header.
    tails = JoinTails(exporters.exporters)
+   names = JoinNames(exporters.exporters)
+
+   # with -j, parse every distinct header and tail in worker processes first
+   parsed = {}
+   if settings.JOBS > 1:
+      parses = {}
+      for interface, header in tails:
+         header_names = CppParser.NamesKey(names.get((interface, header)))
+         parses[(header, tails[(interface, header)], header_names)] = None
+      parsed = parser.ParseInParallel(parses.keys(), settings.JOBS)
 
    # now for each interface file take each header, and using the tail
    # get the declarations and cache them.
    for interface, header in tails:
       tail = tails[(interface, header)]
-      declarations = parser.ParseWithGCCXML(header, tail)
-      cachefile = parser.CreateCache(header, interface, tail, declarations)
+      header_names = names.get((interface, header))
+      key = (header, tail, CppParser.NamesKey(header_names))
+      if key in parsed:
+         declarations = cPickle.loads(parsed[key])
+      else:
+         declarations = parser.ParseWithGCCXML(header, tail, header_names)
+      cachefile = parser.CreateCache(header, interface, tail, declarations,
+                                     header_names)
       print 'Cached', cachefile
 
    return 0
@@ -233,6 +413,8 @@ def JoinTails(exports):
    '''Returns a dict of {(interface, header): tail}, where tail is the
    joining of all tails of all exports for the header.
    '''
+   if settings.SHARE_HEADERS:
+      return JoinSharedTails(exports)
    tails = {}
    for export in exports:
       interface = export.interface_file
@@ -248,6 +430,50 @@ def JoinTails(exports):
    return tails
 
 
+def JoinSharedTails(exports):
+   '''Like JoinTails, but every interface gets the same tail for a header:
+   the distinct tails of the exports of all interfaces, so that the header
+   is parsed only once. The tails are taken in interface name order, so the
+   result doesn't depend on the order the exports are generated in.
+   '''
+   ordered = [(export.interface_file, i, export)
+              for i, export in utils.enumerate(exports)]
+   ordered.sort()
+   header_tails = {}
+   for interface, i, export in ordered:
+      all_tails = header_tails.setdefault(export.Header(), [])
+      tail = export.Tail()
+      if tail and tail not in all_tails:
+         all_tails.append(tail)
+   tails = {}
+   for interface, i, export in ordered:
+      header = export.Header()
+      tails[(interface, header)] = '\n'.join(header_tails[header])
+   return tails
+
+
+def JoinNames(exports):
+   '''Returns a dict of {(interface, header): names}, where names is the list
+   of all declaration names the exports for the header will look up. The dict
+   is empty unless settings.LAZY_PARSE or settings.PRUNE_DECLARATIONS is set,
+   so that everything is parsed and kept.
+   With settings.SHARE_HEADERS, the names of all interfaces are joined.
+   '''
+   names = {}
+   if not settings.LAZY_PARSE and not settings.PRUNE_DECLARATIONS:
+      return names
+   header_names = {}
+   for export in exports:
+      key = (export.interface_file, export.Header())
+      if settings.SHARE_HEADERS:
+         header_names.setdefault(export.Header(), []).extend(
+            export.RequestedNames())
+         names[key] = header_names[export.Header()]
+      else:
+         names.setdefault(key, []).extend(export.RequestedNames())
+   return names
+
+
 def OrderInterfaces(interfaces):
    interfaces_order = [(_imported_count[x], x) for x in interfaces]
    interfaces_order.sort()
@@ -255,11 +481,56 @@ def OrderInterfaces(interfaces):
    return [x for _, x in interfaces_order]
 
 
+def UnchangedExports(parser, exports, tails, names):
+   '''Returns [(manifest, key, inputs, entry)] for each export: the
+   manifest of its output directory, its key and input Fingerprint there,
+   and its entry from the last run if the inputs, the files its
+   declarations came from and its output files are the same; None
+   otherwise.
+   '''
+   run_inputs = Manifest.Fingerprint([__version__, declarations.version,
+                                      Manifest.SourcesDigest(),
+                                      declarations.rename_map,
+                                      vars(settings.namespaces)])
+   manifests = {}
+   result = []
+   for export in exports:
+      if export.cxx_dir not in manifests:
+         manifests[export.cxx_dir] = Manifest.Manifest(export.cxx_dir,
+                                                       declarations.version)
+      manifest = manifests[export.cxx_dir]
+      key = '%s:%s:%s' % (export.interface_file, export.__class__.__name__,
+                          export.Name())
+      header = export.Header()
+      tail = header_names = cache_key = None
+      if header:
+         tail = tails[(export.interface_file, header)]
+         header_names = names.get((export.interface_file, header))
+         cache_key = parser.CacheKey(header, tail, header_names)
+      try:
+         inputs = Manifest.Fingerprint([run_inputs, export.info,
+                                        export.parser_tail, header, tail,
+                                        CppParser.NamesKey(header_names),
+                                        cache_key])
+      except Manifest.FingerprintError, e:
+         # there's no telling whether its inputs changed
+         print "Always exporting %s: %s" % (export.Name(), e)
+         inputs = None
+      entry = manifest.Lookup(key)
+      if entry is not None and \
+         (inputs is None or entry['inputs'] != inputs or
+          Manifest.StampsChanged(entry['outputs']) or
+          parser.DependenciesChanged(entry['dependencies'])):
+         entry = None
+      result.append((manifest, key, inputs, entry))
+   return result
+
 def GenerateCode(parser, out_cxx, out_csharp, interfaces):
    # stop referencing the exporters here
    exports = exporters.exporters
    exporters.exporters = None
-   exported_names = dict([(x.Name(), None) for x in exports])
+   # records the names each export adds, for --incremental
+   exported_names = Manifest.RecordingDict([(x.Name(), None) for x in exports])
 
    # order the exports
    order = {}
@@ -280,10 +551,76 @@ def GenerateCode(parser, out_cxx, out_csharp, interfaces):
    # now generate the code in the correct order
    #print exported_names
    tails = JoinTails(exports)
+   names = JoinNames(exports)
    export_count = len(exports)
+   # with --incremental, the exports that may be skipped aren't parsed ahead
+   to_parse = exports
+   if settings.INCREMENTAL:
+      incremental = UnchangedExports(parser, exports, tails, names)
+      to_parse = [export for export, (manifest, key, inputs, entry)
+                  in zip(exports, incremental) if entry is None]
+      # digest of the exported names seen by each export
+      names_md5 = hashlib.md5()
+      initial_names = exported_names.keys()
+      initial_names.sort()
+      for name in initial_names:
+         names_md5.update(repr(name) + '\0')
+   if settings.UNITY_PARSE:
+      # one translation unit per module
+      module_requests = {}
+      for export in to_parse:
+         interface = export.interface_file
+         header = export.Header()
+         if not header:
+            continue
+         requests = module_requests.setdefault(export.info.module, [])
+         request = (header, interface, tails[(interface, header)],
+                    names.get((interface, header)))
+         if request not in requests:
+            requests.append(request)
+      for module, requests in module_requests.items():
+         print "Parsing %d headers of %s at once..." % (len(requests), module)
+         sys.__stdout__.flush()
+         parser.ParseUnity(requests)
+   elif settings.JOBS > 1:
+      wanted = dict([((x.interface_file, x.Header()), None) for x in to_parse])
+      requests = [(header, interface, tails[(interface, header)],
+                   names.get((interface, header)))
+                  for interface, header in tails
+                  if header and (interface, header) in wanted]
+      print "Parsing %d headers with %d jobs..." % (len(requests), settings.JOBS)
+      sys.__stdout__.flush()
+      parser.Prefetch(requests, settings.JOBS)
+   # with --generate-jobs, Export still runs here, in order, since it reads
+   # and adds to exported_names, but Write runs in a child process forked
+   # right after it, which sees the same state a serial Write would (what a
+   # Write changes, like the exporter's includes, isn't shared with the
+   # other exporters)
+   writers = None
+   if settings.GENERATE_JOBS > 1 and ProcessRunner.CanFork():
+      writers = ProcessRunner.ForkPool(settings.GENERATE_JOBS)
    for i in xrange(len(exports)):
       export = exports[i]
       progress = float(i) / float(export_count)
+      if export.info.module not in modules:
+         modules.append(export.info.module)
+      if settings.INCREMENTAL:
+         manifest, key, inputs, entry = incremental[i]
+         names_digest = names_md5.hexdigest()
+         if entry is not None and entry['names'] == names_digest:
+            print "Skipping %s (%3.2f%%), unchanged" % (export.Name(),
+                                                       progress * 100.0)
+            # as if it ran: the names it added are all the other exporters
+            # see of it (each has its own includes, see Exporter.__init__)
+            for name, value in entry['added']:
+               if name not in exported_names:
+                  exported_names[name] = value
+               names_md5.update(repr(name) + '\0')
+            manifest.Record(key, entry)
+            exports[i] = None
+            del export
+            continue
+         first_added = len(exported_names.added)
       print "Exporting %s (%3.2f%%)" % (export.Name(), progress * 100.0)
       interface = export.interface_file
       header = export.Header()
@@ -292,23 +629,56 @@ def GenerateCode(parser, out_cxx, out_csharp, interfaces):
          # declarations contains everything read in from parsing header.
          print "\tParsing %s..." % header,
          sys.__stdout__.flush()
-         declarations, parsed_header = parser.Parse(header, interface, tail)
+         declarations, parsed_header = parser.Parse(header, interface, tail,
+                                                    names.get((interface, header)))
          print "Done."
       else:
          declarations = []
          parsed_header = None
       ExpandTypedefs(declarations, exported_names)
-      if export.info.module not in modules:
-         modules.append(export.info.module)
       export.SetDeclarations(declarations)
       export.SetParsedHeader(parsed_header)
-      export.GenerateCode(exported_names)
-      # force collect of cyclic references
+      if writers is None:
+         export.GenerateCode(exported_names)
+      else:
+         export.Export(exported_names)
+      Done = None
+      if settings.INCREMENTAL:
+         added = exported_names.added[first_added:]
+         for name, value in added:
+            names_md5.update(repr(name) + '\0')
+         if header:
+            dependencies = parser.Dependencies(declarations)
+         else:
+            dependencies = []
+         entry = {'inputs': inputs, 'names': names_digest,
+                  'dependencies': dependencies, 'added': added}
+         # once the files are written
+         def Done(manifest=manifest, key=key, entry=entry,
+                  files=export.OutputFiles()):
+            entry['outputs'] = Manifest.Stamps(files)
+            manifest.Record(key, entry)
+      if writers is not None:
+         writers.Start(export.Write, (), Done)
+      elif Done is not None:
+         Done()
+      # force collect of cyclic references; with --generate-jobs, only once
+      # per round of writers
       exports[i] = None
       del declarations
       del export
-      gc.collect()
-
+      if writers is None or i % settings.GENERATE_JOBS == 0:
+         gc.collect()
+
+   if writers is not None:
+      writers.Join()
+
+   if settings.INCREMENTAL:
+      saved = {}
+      for manifest, key, inputs, entry in incremental:
+         if manifest.filename not in saved:
+            manifest.Save()
+            saved[manifest.filename] = None
    print 'Modules (%s) generated' % ', '.join(modules)
    return 0
 
@@ -334,6 +704,15 @@ def main():
    UsePsyco()
    status = Begin()
    print '%0.2f seconds' % (time.clock()-start)
+   peak = None
+   if settings.PROFILE:
+      peak = utils.peak_memory()
+   if peak is not None:
+      if settings.STREAM_XML:
+         mode = 'streaming'
+      else:
+         mode = 'tree'
+      print 'Peak memory: %d KB (%s xml parsing)' % (peak, mode)
    sys.exit(status)
 
 
@@ -118,6 +118,24 @@ def left_equals(s):
         return s + ('='*(80-len(s))) + '\n'  
 
 
+#==============================================================================
+# peak_memory
+#==============================================================================
+def peak_memory():
+    '''Returns the peak resident set size of this process in kilobytes, or
+    None if the platform does not report it.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes instead of kilobytes
+        peak = peak / 1024
+    return peak
+
+
 #==============================================================================
 # post_mortem    
 #==============================================================================